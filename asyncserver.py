@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import metrics
+import protocol
+import server
+import serverlog
+from user import User
+
+# One wakeup event per connected user, set by server.queue_message.
+writer_wakeups = {}
+
+
+def wake_writer(user) -> None:
+    wakeup = writer_wakeups.get(user)
+    if wakeup is not None:
+        wakeup.set()
+
+
+async def write_messages(writer, user, wakeup) -> None:
+    """Writer task: sleeps until messages are queued for the user, then flushes them."""
+    while not writer.is_closing():
+        await wakeup.wait()
+        wakeup.clear()
+        queue = user.message_queue
+        if queue.overflowed:
+            server.slow_consumers.discard(user)
+            writer.close()  # the reader task sees the connection end and removes the user
+            break
+        # Hand over what is queued now; new messages wait in the byte-budgeted queue until drain() returns.
+        while len(queue) > 0:
+            batch = queue.peek_batch(server.SEND_BATCH_MESSAGES, server.SEND_BATCH_BYTES)
+            writer.writelines(batch)
+            sent = sum(map(len, batch))
+            queue.consume(sent)
+            server.bytes_sent.inc(amount=sent)
+        if writer.is_closing():
+            break
+        try:
+            await writer.drain()
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+            logging.error(f"Connection reset during send to {user.name}")
+            break
+
+
+async def read_commands(reader, writer, user) -> None:
+    """Reader task: feeds every command the client sends into the regular server handlers."""
+    while writer in server.open_client_sockets:
+        data = await protocol.read_analyzed_data(reader, user.protocol_version)
+        if data == b"":
+            logging.info("Connection Closed")
+            break
+        server.handle_command_request(writer, data)
+
+
+async def handle_connection(reader, writer) -> None:
+    client_address = writer.get_extra_info("peername")
+    logging.info(f"New client {client_address} joined!")
+    try:
+        handshake = await asyncio.wait_for(
+            protocol.read_analyzed_data(reader, max_message_size=server.MAX_HANDSHAKE_SIZE), server.HANDSHAKE_TIMEOUT)
+        if not handshake:
+            server.handshakes_failed.inc("closed")
+            writer.close()
+            return
+        username, capabilities, history_since = protocol.parse_handshake(handshake)
+    except asyncio.TimeoutError:
+        logging.info(f"Handshake of {client_address} timed out")
+        server.handshakes_failed.inc("timeout")
+        writer.close()
+        return
+    except (ValueError, ConnectionError, asyncio.LimitOverrunError) as e:
+        # LimitOverrunError: the stream buffer filled up before the length delimiter came
+        logging.error(f"Invalid handshake from {client_address}: {e}")
+        server.handshakes_failed.inc("invalid")
+        writer.close()
+        return
+
+    new_user: User = server.register_user(username, writer, client_address, capabilities, history_since)
+    writer.write(protocol.create_handshake_reply(new_user.id, capabilities))
+    logging.info(f"Assigned UUID {new_user.id} to {new_user.name} (protocol v{new_user.protocol_version})")
+
+    wakeup = asyncio.Event()
+    writer_wakeups[new_user] = wakeup
+    wakeup.set()  # flush anything queued while registering
+    writer_task = asyncio.create_task(write_messages(writer, new_user, wakeup))
+    try:
+        await read_commands(reader, writer, new_user)
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+        logging.error(f"Client crashed: {client_address}")
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+    finally:
+        writer_task.cancel()
+        writer_wakeups.pop(new_user, None)
+        # A kick or QUIT already removed the user; otherwise the peer went away on its own.
+        if writer in server.open_client_sockets:
+            server.handle_client_quiting(writer, new_user)
+
+
+async def handle_metrics_request(reader, writer) -> None:
+    try:
+        request_head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), metrics.SCRAPE_TIMEOUT)
+        writer.write(metrics.http_response(request_head))
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port, metrics_address=None) -> None:
+    """With a metrics_address, also serves the metrics over HTTP on a (host, port) or a unix socket path."""
+    server.on_message_queued = wake_writer
+    if isinstance(metrics_address, str):
+        await asyncio.start_unix_server(handle_metrics_request, metrics_address)
+    elif metrics_address is not None:
+        await asyncio.start_server(handle_metrics_request, *metrics_address)
+    async_server = await asyncio.start_server(handle_connection, host, port)
+    print("Listening for clients...")
+    async with async_server:
+        await async_server.serve_forever()
+
+
+def main() -> None:
+    """
+    Start the server in asyncio mode. Same commands as server.py, one reader and one writer task per client.
+    """
+    print("Setting up server...")
+    serverlog.setup('log.log')
+    server.open_history()
+    try:
+        asyncio.run(serve(protocol.SERVER_IP, protocol.SERVER_PORT, (metrics.METRICS_HOST, metrics.METRICS_PORT)))
+    except KeyboardInterrupt:
+        logging.info("Shutting down server gracefully...")
+    finally:
+        server.user_manager.clear_user_manager()
+        server.open_client_sockets.clear()
+        server.close_history()
+        serverlog.stop()
+
+
+if __name__ == '__main__':
+    main()
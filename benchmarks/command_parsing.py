@@ -0,0 +1,38 @@
+"""
+Time server.analyze_command takes per message, for text commands and for frames of growing size.
+A frame's payload is not copied, so its cost should not grow with the frame.
+
+    python -m benchmarks.command_parsing [rounds]
+"""
+import sys
+import time
+import server
+
+DEFAULT_ROUNDS = 200_000
+FRAME_SIZES = (1_000, 100_000, 1_000_000)
+
+
+def measure_us_per_message(sock, data, rounds) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        server.analyze_command(sock, data)
+    return (time.perf_counter() - started) / rounds * 1e6
+
+
+def main() -> None:
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROUNDS
+    sock = object()  # stands in for a client socket, only used as a key
+    user = server.user_manager.create_user("bench", sock, ("127.0.0.1", 10000))
+    messages = {
+        "SEND_MESSAGE": f"{user.id}|0|SEND_MESSAGE|hello everyone, how is it going?".encode(),
+        "SEND_PRIVATE_MESSAGE": f"{user.id}|0|SEND_PRIVATE_MESSAGE|alice|see you at five".encode(),
+        "LEAVE_SHARE_SCREEN": f"{user.id}|0|LEAVE_SHARE_SCREEN|".encode(),
+    }
+    for size in FRAME_SIZES:
+        messages[f"frame {size} bytes"] = f"{user.id}|1|".encode() + b"\xff\xd8" + bytes(size)
+    for name, data in messages.items():
+        print(f"{name:<24}{measure_us_per_message(sock, data, rounds):>8.2f} us")
+
+
+if __name__ == '__main__':
+    main()
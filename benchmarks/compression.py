@@ -0,0 +1,70 @@
+"""
+CPU cost and size of compressed payloads, per kind of message the server sends: a message is framed
+(and compressed) once per broadcast and inflated once by every client that negotiated compression.
+
+    python -m benchmarks.compression [rounds]
+"""
+import random
+import sys
+import time
+import message
+import protocol
+
+DEFAULT_ROUNDS = 20_000
+WORDS = ("hello", "anyone", "up", "for", "a", "call", "later", "today", "the", "build", "is", "green", "again",
+         "thanks", "can", "you", "check", "this", "link", "https://example.com/docs/page", "lol", "ok", "sure")
+
+
+def sample_messages():
+    """Typical payloads, as rendered by the server."""
+    text = message.Message.MESSAGE_TYPES["Text"]
+    sentence = " ".join(random.choice(WORDS) for _ in range(12))
+    return {
+        "chat": message.ChatMessage(sentence, text, "alice"),
+        "room": message.RoomMessage(sentence, text, "alice", "general"),
+        "private": message.PrivateMessage(sentence, text, "bob"),
+        "notice": message.TextSystemMessage("carol joined the chat.", text),
+        "status": message.TextSystemMessage("carol status changed to UserStatus.Administrator.", text),
+        "long chat": message.ChatMessage(" ".join(random.choice(WORDS) for _ in range(120)), text, "alice"),
+    }
+
+
+def measure(payload, rounds):
+    """Returns (compressed size, microseconds to compress, microseconds to decompress)."""
+    compressed = protocol.compress_payload(payload)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        protocol.compress_payload(payload)
+    compress_us = (time.perf_counter() - started) / rounds * 1e6
+    started = time.perf_counter()
+    for _ in range(rounds):
+        protocol.decompress_payload(compressed)
+    decompress_us = (time.perf_counter() - started) / rounds * 1e6
+    return len(compressed), compress_us, decompress_us
+
+
+def main() -> None:
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROUNDS
+    random.seed(1)
+    print(f"{'message':<12}{'bytes':>8}{'zlib':>8}{'ratio':>8}{'comp us':>10}{'decomp us':>11}")
+    for name, message_obj in sample_messages().items():
+        payload = message_obj.create_message().encode()
+        size, compress_us, decompress_us = measure(payload, rounds)
+        sent = "" if len(payload) >= protocol.COMPRESSION_THRESHOLD and size < len(payload) else " (sent plain)"
+        print(f"{name:<12}{len(payload):>8}{size:>8}{size / len(payload):>8.2f}{compress_us:>10.1f}"
+              f"{decompress_us:>11.1f}{sent}")
+    # A history replay is a burst of chat lines to one user, each compressed on its own
+    replay = [message.ChatMessage(" ".join(random.choice(WORDS) for _ in range(12)),
+                                  message.Message.MESSAGE_TYPES["Text"], f"user{index % 7}")
+              for index in range(50)]
+    plain = sum(len(protocol.create_message(m.create_message(), protocol.PROTOCOL_V2)) for m in replay)
+    started = time.perf_counter()
+    compressed = sum(len(protocol.create_message(m.create_message(), protocol.PROTOCOL_V2, compress=True))
+                     for m in replay)
+    elapsed_us = (time.perf_counter() - started) * 1e6
+    print(f"history replay of {len(replay)} messages: {plain} -> {compressed} bytes, "
+          f"{elapsed_us / len(replay):.1f} us per message")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Cost of relaying one screen-share frame to its watchers: time per frame and bytes allocated per frame.
+Every v2 watcher gets the same framed buffer, so the allocation should stay near one frame whatever
+the number of watchers.
+
+    python -m benchmarks.frame_relay [watchers] [frame bytes]
+"""
+import sys
+import time
+import tracemalloc
+import protocol
+import server
+
+DEFAULT_WATCHERS = 50
+DEFAULT_FRAME_SIZE = 300_000  # a 1080p JPEG keyframe
+ROUNDS = 200
+
+
+def create_watchers(count):
+    watchers = {}
+    for index in range(count):
+        user = server.user_manager.create_user(f"watcher{index}", object(), ("127.0.0.1", 10000 + index))
+        user.protocol_version = protocol.PROTOCOL_V2
+        watchers[user] = None
+    return watchers
+
+
+def relay(frame, watchers):
+    """Parses a received frame and queues it to every watcher, as the server does without other nodes."""
+    _, _, _, content, _ = server.analyze_command(sharer_socket, frame)
+    server.send_frame(content, watchers)
+
+
+def main() -> None:
+    global sharer_socket
+    watcher_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_WATCHERS
+    frame_size = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_FRAME_SIZE
+    sharer_socket = object()
+    sharer = server.user_manager.create_user("sharer", sharer_socket, ("127.0.0.1", 9999))
+    watchers = create_watchers(watcher_count)
+    frame = f"{sharer.id}|1|".encode() + b"\xff\xd8" + bytes(frame_size)
+
+    relay(frame, watchers)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    relay(frame, watchers)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        relay(frame, watchers)
+    elapsed = (time.perf_counter() - started) / ROUNDS
+    print(f"{frame_size} byte frame to {watcher_count} watchers: {elapsed * 1e6:.0f} us per frame, "
+          f"{(peak - before) / frame_size:.2f} frames allocated")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+"""
+Load generator: thousands of simulated clients speaking the real protocol, in one asyncio process.
+Every client handshakes, joins a room, and sends room or private messages at a fixed rate. A few of
+them share their screen with synthetic frames and others watch. Messages and frames carry their
+send time, so every delivery gives an end-to-end latency sample.
+
+    python -m benchmarks.loadgen --clients 2000 --duration 30 --output results.json
+    python -m benchmarks.loadgen --server-pid 1234 --port 5555   # measure a server started elsewhere
+
+Without --server-pid a server is started for the run (--server sync or async). Results are printed,
+and saved as JSON with --output so runs can be compared over time. Linux only, server CPU and memory
+are read from /proc.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+import protocol
+
+BENCH_MARKER = b"BENCH "
+FRAME_HEADER = struct.Struct("!2sQ")  # JPEG start marker so the server sees a keyframe, send time
+JPEG_START = b"\xff\xd8"
+CONNECT_CONCURRENCY = 100
+SERVER_START_TIMEOUT = 10.0
+SAMPLE_INTERVAL = 0.5  # seconds between server CPU and memory samples
+PERCENTILES = {"p50": 0.50, "p99": 0.99, "p999": 0.999}
+
+
+class Stats:
+    """Counters of the whole run, shared by every simulated client."""
+
+    def __init__(self):
+        self.measuring = False
+        self.messages_sent = 0
+        self.expected_deliveries = 0
+        self.delivered = 0
+        self.latencies_ns = []
+        self.frames_sent = 0
+        self.expected_frames = 0
+        self.frames_delivered = 0
+        self.frame_latencies_ns = []
+        self.bytes_received = 0  # on the wire, before decompressing
+        self.compressed_received = 0
+        self.errors = 0
+        self.connect_failures = 0
+
+
+class SimulatedClient:
+    def __init__(self, index, room, room_members, stats, config):
+        self.index = index
+        self.name = f"bench{index}"
+        self.room = room
+        self.room_members = room_members
+        self.stats = stats
+        self.config = config
+        self.uuid = None
+        self.version = protocol.PROTOCOL_V1
+        self.reader = None
+        self.writer = None
+        self.watchers = 0  # for a sharer, how many clients watch it
+
+    async def connect(self, host, port) -> None:
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        capabilities = set() if self.config.v1 else protocol.SUPPORTED_CAPABILITIES
+        if self.config.no_compression:
+            capabilities = capabilities - {protocol.CAPABILITY_ZLIB}
+        self.writer.write(protocol.create_handshake(self.name, capabilities))
+        reply = await protocol.read_analyzed_data(self.reader)
+        self.uuid, capabilities = protocol.parse_handshake_reply(reply)
+        self.version = protocol.get_protocol_version(capabilities)
+
+    def send_command(self, command, content="") -> None:
+        self.writer.write(protocol.create_message(f"{self.uuid}|0|{command}|{content}", self.version))
+
+    def send_frame(self) -> None:
+        frame = FRAME_HEADER.pack(JPEG_START, time.monotonic_ns()) + bytes(self.config.frame_size)
+        self.writer.write(protocol.create_message(f"{self.uuid}|1|".encode() + frame, self.version, "1"))
+        if self.stats.measuring:
+            self.stats.frames_sent += 1
+            self.stats.expected_frames += self.watchers
+
+    async def read_message(self):
+        """Returns the payload and how many bytes it took on the wire, or (b"", 0) when the server closed."""
+        if self.version != protocol.PROTOCOL_V2:
+            data = await protocol.read_analyzed_data(self.reader, self.version, max_message_size=1 << 30)
+            return data, len(data) * 4 // 3
+        try:
+            datasize, _, flags = protocol.V2_HEADER.unpack(await self.reader.readexactly(protocol.V2_HEADER.size))
+            data = await self.reader.readexactly(datasize)
+        except asyncio.IncompleteReadError:
+            return b"", 0
+        wire_size = protocol.V2_HEADER.size + datasize
+        if flags & protocol.FLAG_COMPRESSED:
+            self.stats.compressed_received += 1
+            return protocol.decompress_payload(data), wire_size
+        return data, wire_size
+
+    async def receive(self) -> None:
+        stats = self.stats
+        while True:
+            data, wire_size = await self.read_message()
+            if not data:
+                return
+            stats.bytes_received += wire_size
+            if data[:2] == b"1|":
+                if stats.measuring:
+                    stats.frames_delivered += 1
+                    _, sent_ns = FRAME_HEADER.unpack_from(data, 2)
+                    stats.frame_latencies_ns.append(time.monotonic_ns() - sent_ns)
+                continue
+            marker = data.find(BENCH_MARKER)
+            if marker != -1:
+                if stats.measuring:
+                    stats.delivered += 1
+                    sent_ns = int(data[marker + len(BENCH_MARKER):].split(maxsplit=1)[0])
+                    stats.latencies_ns.append(time.monotonic_ns() - sent_ns)
+            elif b"Error" in data:
+                stats.errors += 1
+
+    async def chat(self, peers) -> None:
+        """Sends messages at the configured rate, starting at a random phase so clients do not send together."""
+        interval = 1 / self.config.rate
+        await asyncio.sleep(random.random() * interval)
+        while True:
+            if random.random() < self.config.private_ratio and len(peers) > 1:
+                recipient = self.name
+                while recipient == self.name:
+                    recipient = random.choice(peers)
+                self.send_command("SEND_PRIVATE_MESSAGE", f"{recipient}|{BENCH_MARKER.decode()}{time.monotonic_ns()}")
+                expected = 1
+            elif self.room is not None:
+                self.send_command("ROOM_MESSAGE", f"{self.room}|{BENCH_MARKER.decode()}{time.monotonic_ns()}")
+                expected = self.room_members - 1
+            else:
+                self.send_command("SEND_MESSAGE", f"{BENCH_MARKER.decode()}{time.monotonic_ns()}")
+                expected = self.config.clients - 1
+            if self.stats.measuring:
+                self.stats.messages_sent += 1
+                self.stats.expected_deliveries += expected
+            await self.writer.drain()
+            await asyncio.sleep(interval)
+
+    async def share(self) -> None:
+        interval = 1 / self.config.fps
+        while True:
+            self.send_frame()
+            await self.writer.drain()
+            await asyncio.sleep(interval)
+
+
+def raise_fd_limit() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def read_process_stats(pid):
+    """Returns (cpu seconds, resident bytes) of a process from /proc."""
+    with open(f"/proc/{pid}/stat") as stat_file:
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")  # utime + stime
+    with open(f"/proc/{pid}/statm") as statm_file:
+        resident_pages = int(statm_file.read().split()[1])
+    return cpu_seconds, resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+async def sample_server(pids, samples) -> None:
+    while True:
+        try:
+            samples.append([read_process_stats(pid) for pid in pids])
+        except (FileNotFoundError, ProcessLookupError):
+            return
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+def percentiles(latencies_ns):
+    if not latencies_ns:
+        return {}
+    ordered = sorted(latencies_ns)
+    result = {name: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] / 1e6
+              for name, fraction in PERCENTILES.items()}
+    result["mean"] = sum(ordered) / len(ordered) / 1e6
+    result["max"] = ordered[-1] / 1e6
+    return result
+
+
+def start_server(mode, host, port):
+    """The server's stdout is discarded so only the JSON result is printed there, its errors still reach stderr."""
+    process = subprocess.Popen([sys.executable, "-m", "benchmarks.loadgen", "--serve", mode,
+                                "--host", host, "--port", str(port)], stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+
+def serve(mode, host, port) -> None:
+    """Runs a server for the benchmark, without a log file so logging does not skew the numbers."""
+    import logging
+    import server
+    raise_fd_limit()
+    logging.basicConfig(level=logging.ERROR)
+    if mode == "async":
+        import asyncserver
+        asyncio.run(asyncserver.serve(host, port))
+        return
+    server_socket = socket.create_server((host, port), backlog=socket.SOMAXCONN)
+    server.serve(server_socket)
+
+
+async def run(config, pids):
+    stats = Stats()
+    clients = []
+    rooms = {}
+    for index in range(config.clients):
+        room = f"room{index // config.room_size}" if config.room_size else None
+        rooms[room] = rooms.get(room, 0) + 1
+        clients.append(SimulatedClient(index, room, 0, stats, config))
+    for client in clients:
+        client.room_members = rooms[client.room]
+
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(client):
+        async with semaphore:
+            try:
+                await client.connect(config.host, config.port)
+            except (OSError, ValueError):
+                stats.connect_failures += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(connect(client) for client in clients))
+    clients = [client for client in clients if client.uuid is not None]
+    connect_seconds = time.monotonic() - started
+    tasks = [asyncio.create_task(client.receive()) for client in clients]
+    for client in clients:
+        if client.room is not None:
+            client.send_command("JOIN_ROOM", client.room)
+
+    sharers = clients[:config.sharers]
+    watchers = clients[config.sharers:config.sharers + config.watchers]
+    for sharer in sharers:
+        sharer.send_command("START_SHARE_SCREEN")
+    await asyncio.sleep(config.warmup)
+    for position, watcher in enumerate(watchers):
+        if sharers:
+            sharer = sharers[position % len(sharers)]
+            watcher.send_command("JOIN_SHARE_SCREEN", sharer.name)
+            sharer.watchers += 1
+    await asyncio.sleep(config.warmup)
+
+    names = [client.name for client in clients]
+    tasks += [asyncio.create_task(client.chat(names)) for client in clients if config.rate > 0]
+    tasks += [asyncio.create_task(sharer.share()) for sharer in sharers]
+    samples = []
+    sampler = asyncio.create_task(sample_server(pids, samples)) if pids else None
+    await asyncio.sleep(config.warmup)
+
+    stats.measuring = True
+    measure_start = time.monotonic()
+    server_start = [read_process_stats(pid) for pid in pids]
+    await asyncio.sleep(config.duration)
+    for task in tasks[len(clients):]:
+        task.cancel()  # stop sending, keep receiving what is still on its way
+    server_end = [read_process_stats(pid) for pid in pids]
+    measured_seconds = time.monotonic() - measure_start
+    await asyncio.sleep(config.drain)
+    stats.measuring = False
+    for task in tasks:
+        task.cancel()
+    if sampler is not None:
+        sampler.cancel()
+    for client in clients:
+        client.writer.close()
+
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "config": {name: value for name, value in vars(config).items() if name != "serve"},
+        "clients_connected": len(clients),
+        "connect_failures": stats.connect_failures,
+        "connect_seconds": connect_seconds,
+        "measured_seconds": measured_seconds,
+        "messages": {
+            "sent": stats.messages_sent,
+            "sent_per_second": stats.messages_sent / measured_seconds,
+            "expected_deliveries": stats.expected_deliveries,
+            "delivered": stats.delivered,
+            "delivered_per_second": stats.delivered / measured_seconds,
+            "dropped": max(0, stats.expected_deliveries - stats.delivered),
+            "errors": stats.errors,
+            "latency_ms": percentiles(stats.latencies_ns),
+        },
+        "frames": {
+            "sent": stats.frames_sent,
+            "expected_deliveries": stats.expected_frames,
+            "delivered": stats.frames_delivered,
+            # A watcher only gets the newest frame, so frames behind a slow watcher are skipped on purpose
+            "skipped": max(0, stats.expected_frames - stats.frames_delivered),
+            "latency_ms": percentiles(stats.frame_latencies_ns),
+        },
+        "bytes_received": stats.bytes_received,
+        "compressed_messages_received": stats.compressed_received,
+    }
+    if pids:
+        cpu_seconds = sum(end[0] - start[0] for start, end in zip(server_start, server_end))
+        result["server"] = {
+            "pids": pids,
+            "cpu_seconds": cpu_seconds,
+            "cpu_percent": 100 * cpu_seconds / measured_seconds,
+            # Compare runs with and without --no-compression to get the cost of compressing
+            "cpu_us_per_delivery": 1e6 * cpu_seconds / max(1, stats.delivered + stats.frames_delivered),
+            "rss_peak_bytes": max((sum(rss for _, rss in sample) for sample in samples), default=0),
+            "rss_end_bytes": sum(rss for _, rss in server_end),
+        }
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulated clients for the chat server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5600)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per client")
+    parser.add_argument("--private-ratio", type=float, default=0.1, help="part of the messages sent privately")
+    parser.add_argument("--room-size", type=int, default=20, help="clients per room, 0 to chat in the whole chat")
+    parser.add_argument("--sharers", type=int, default=1)
+    parser.add_argument("--watchers", type=int, default=20)
+    parser.add_argument("--fps", type=float, default=10)
+    parser.add_argument("--frame-size", type=int, default=50_000, help="bytes per synthetic frame")
+    parser.add_argument("--duration", type=float, default=20, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds between setup steps")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for deliveries after sending stops")
+    parser.add_argument("--v1", action="store_true", help="use the base64 protocol")
+    parser.add_argument("--no-compression", action="store_true", help="do not ask for compressed payloads")
+    parser.add_argument("--server", choices=["sync", "async"], default="sync", help="server started for the run")
+    parser.add_argument("--server-pid", type=int, action="append", help="measure running server processes")
+    parser.add_argument("--output", help="JSON file to save the results to")
+    parser.add_argument("--serve", choices=["sync", "async"], help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    config = parse_args()
+    if config.serve:
+        serve(config.serve, config.host, config.port)
+        return
+    raise_fd_limit()
+    server_process = None
+    pids = config.server_pid
+    if pids is None:
+        server_process = start_server(config.server, config.host, config.port)
+        pids = [server_process.pid]
+    try:
+        result = asyncio.run(run(config, pids))
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+    print(json.dumps(result, indent=2))
+    if config.output:
+        with open(config.output, "w") as output_file:
+            json.dump(result, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+Memory per connected user, as the server holds it: a User with its outbound queue, registered in a
+UserManager, its entry in the open sockets set, and the MessageDecoder of its connection.
+Sockets are stood in by plain objects so only the server's own structures are measured.
+
+    python -m benchmarks.user_memory [users]
+"""
+import gc
+import sys
+import tracemalloc
+import protocol
+from usermanager import UserManager
+
+DEFAULT_USERS = 10_000
+
+
+def measure_bytes_per_user(users=DEFAULT_USERS) -> float:
+    user_manager = UserManager()
+    open_client_sockets = {}
+    message_decoders = {}
+    sockets = [object() for _ in range(users)]
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for index, sock in enumerate(sockets):
+        # What server.register_user and server.complete_handshake keep for a connection
+        user = user_manager.create_user(f"user{index}", sock, ("127.0.0.1", 10000 + index))
+        open_client_sockets[sock] = None
+        message_decoders[sock] = protocol.MessageDecoder(user.protocol_version)
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (after - before) / users
+
+
+def main() -> None:
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_USERS
+    print(f"{users} users: {measure_bytes_per_user(users):.0f} bytes per user")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import time
+
+# Settings from the best picture to the lightest stream: (jpeg quality, downscale factor, frames per second)
+LEVELS = [(90, 1.0, 15),
+          (80, 1.0, 10),
+          (70, 0.75, 10),
+          (60, 0.75, 8),
+          (50, 0.5, 6),
+          (40, 0.5, 4)]
+MAX_WATCHER_QUEUE_BYTES = 512 * 1024  # more than this waiting for the slowest watcher counts as congestion
+DOWNGRADE_COOLDOWN = 1.0  # seconds, so one burst of bad reports only costs one level
+UPGRADE_AFTER = 3.0  # seconds without congestion before trying a better level
+
+
+class AdaptiveBitrateController:
+    """
+    Picks the screen-share settings from congestion feedback: frames the client had to replace because
+    the socket was not ready for them, and the STREAM_STATS the server sends about the watchers.
+    Steps one level down right away on congestion, and one level up after a quiet period.
+    """
+
+    def __init__(self, level=1):
+        self.level = level
+        self._last_change = time.monotonic()
+        self._last_congestion = 0.0
+
+    @property
+    def quality(self):
+        return LEVELS[self.level][0]
+
+    @property
+    def scale(self):
+        return LEVELS[self.level][1]
+
+    @property
+    def fps(self):
+        return LEVELS[self.level][2]
+
+    def on_local_drop(self):
+        """The previous frame was still waiting for the socket when the next one was ready."""
+        self._on_congestion()
+
+    def on_server_report(self, watcher_queued_bytes, frames_dropped):
+        if frames_dropped > 0 or watcher_queued_bytes > MAX_WATCHER_QUEUE_BYTES:
+            self._on_congestion()
+        else:
+            self._maybe_upgrade()
+
+    def _on_congestion(self):
+        now = time.monotonic()
+        self._last_congestion = now
+        if self.level < len(LEVELS) - 1 and now - self._last_change >= DOWNGRADE_COOLDOWN:
+            self.level += 1
+            self._last_change = now
+
+    def _maybe_upgrade(self):
+        now = time.monotonic()
+        if self.level > 0 and now - max(self._last_congestion, self._last_change) >= UPGRADE_AFTER:
+            self.level -= 1
+            self._last_change = now
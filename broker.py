@@ -0,0 +1,139 @@
+import logging
+import selectors
+import socket
+import sys
+import cluster
+import protocol
+import serverlog
+from user import OutboundQueue, SlowConsumerPolicy
+
+BROKER_HOST = "127.0.0.1"
+BROKER_PORT = 5556
+
+
+class NodeLink:
+    """A node connected to the broker. Its id is learned from the first event it sends, its hello."""
+
+    __slots__ = ("sock", "node_id", "decoder", "queue")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.node_id = None
+        self.decoder = protocol.MessageDecoder(protocol.PROTOCOL_V2, cluster.MAX_EVENT_SIZE)
+        self.queue = OutboundQueue(cluster.PEER_QUEUE_MESSAGES, cluster.PEER_QUEUE_BYTES,
+                                   SlowConsumerPolicy.DropNewest)
+        sock.setblocking(False)
+
+
+class Broker:
+    """
+    Reference broker for federated servers. Every node keeps one connection to it, and each event is
+    forwarded once to every node in its "to" list, or to every other node. Only event headers are read.
+    serve_forever can run in its own process, or in a thread next to a node for a test on one machine.
+    """
+
+    def __init__(self, host=BROKER_HOST, port=BROKER_PORT):
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.create_server((host, port))
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.links = {}  # node id -> NodeLink
+
+    def serve_forever(self) -> None:
+        while True:
+            for key, events in self.selector.select():
+                if key.fileobj is self.listener:
+                    self._accept()
+                elif key.fileobj.fileno() != -1:
+                    self._handle_io(key.data, events)
+
+    def _accept(self) -> None:
+        try:
+            sock, address = self.listener.accept()
+        except BlockingIOError:
+            return
+        logging.info(f"Node connected from {address}")
+        link = NodeLink(sock)
+        self.selector.register(sock, selectors.EVENT_READ, link)
+
+    def _handle_io(self, link, events) -> None:
+        try:
+            if events & selectors.EVENT_READ:
+                if not link.decoder.recv_from(link.sock):
+                    self._drop(link)
+                    return
+                for data in link.decoder.messages():
+                    try:
+                        self._route(link, data)
+                    except Exception as e:
+                        logging.error(f"Cannot route an event from node {link.node_id}: {e!r}")
+            if events & selectors.EVENT_WRITE:
+                link.queue.flush(link.sock, cluster.SEND_BATCH_MESSAGES, cluster.SEND_BATCH_BYTES)
+                if len(link.queue) == 0:
+                    self.selector.modify(link.sock, selectors.EVENT_READ, link)
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, ValueError) as e:
+            logging.error(f"Connection to node {link.node_id} failed: {e}")
+            self._drop(link)
+
+    def _route(self, link, data) -> None:
+        header, _ = cluster.decode_event_header(data)
+        if link.node_id is None:
+            link.node_id = header["node"]
+            self.links[link.node_id] = link
+            logging.info(f"Node {link.node_id} joined")
+        targets = header.get("to")
+        if targets is None:
+            targets = [node for node in self.links if node != link.node_id]
+        is_frame = header["event"] == "frame"
+        wire_bytes = protocol.create_message(data, protocol.PROTOCOL_V2)
+        for node in targets:
+            target = self.links.get(node)
+            if target is not None:
+                self._send(target, wire_bytes, cluster.FRAME_LANE if is_frame else cluster.CONTROL_LANE,
+                           droppable=is_frame and not header.get("keyframe"))
+
+    def _send(self, link, wire_bytes, lane, droppable=False) -> None:
+        if droppable and link.queue.queued_bytes > cluster.PEER_FRAME_BACKLOG:
+            return
+        if not link.queue.push(wire_bytes, lane):
+            logging.warning(f"Queue to node {link.node_id} is full. Dropping event.")
+            return
+        if not self.selector.get_key(link.sock).events & selectors.EVENT_WRITE:
+            self.selector.modify(link.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, link)
+
+    def _drop(self, link) -> None:
+        """Tells the other nodes to forget the users of a node that went away."""
+        self.selector.unregister(link.sock)
+        link.sock.close()
+        if link.node_id is None or self.links.get(link.node_id) is not link:
+            return
+        del self.links[link.node_id]
+        logging.info(f"Node {link.node_id} left")
+        wire_bytes = cluster.encode_event("node_lost", node=link.node_id)
+        for other in self.links.values():
+            self._send(other, wire_bytes, cluster.CONTROL_LANE)
+
+    def close(self) -> None:
+        for link in self.links.values():
+            link.sock.close()
+        self.selector.close()
+        self.listener.close()
+
+
+def main() -> None:
+    """python broker.py [port]"""
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else BROKER_PORT
+    serverlog.setup('log_broker.log')
+    broker = Broker(BROKER_HOST, port)
+    print(f"Broker listening on {BROKER_HOST}:{port}")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down broker...")
+    finally:
+        broker.close()
+        serverlog.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,21 +4,31 @@ import protocol
 import msvcrt
 import threading
 import queue
+import time
+from collections import deque
 import cv2
 from screensharemanager import ScreenShareManager
+from bitratecontroller import AdaptiveBitrateController
 
 input_queue = queue.Queue()
 console_lock = threading.Lock()
 print_queue = queue.Queue()  # Store messages while user is typing
 is_typing = False  # Track typing state
+ADAPTIVE_BITRATE = True  # otherwise frames are captured at TARGET_FPS with the default quality
+TARGET_FPS = 10  # screen-share frames per second, independent of the select timeout
+bitrate_controller = AdaptiveBitrateController()
+frame_slot = queue.Queue(maxsize=1)  # (newest encoded frame, is keyframe), waiting for the socket to be writable
+wakeup_receiver, wakeup_sender = socket.socketpair()  # lets the capture thread wake the network loop
 
 available_commands = ["SEND_MESSAGE", "CHANGE_NAME", "CHANGE_STATUS", "KICK_USER", "SEND_PRIVATE_MESSAGE",
-                      "START_SHARE_SCREEN", "END_SHARE_SCREEN", "JOIN_SHARE_SCREEN", "LEAVE_SHARE_SCREEN", "QUIT"]
+                      "START_SHARE_SCREEN", "END_SHARE_SCREEN", "JOIN_SHARE_SCREEN", "LEAVE_SHARE_SCREEN", "QUIT",
+                      "JOIN_ROOM", "LEAVE_ROOM", "ROOM_MESSAGE", "STATS"]
 MESSAGE_TYPES = {"Text": "0", "Binary": "1", "System": "2"}
 pending_for_start = False  # Tracks START_SHARE_SCREEN
 pending_for_join = False  # Tracks JOIN_SHARE_SCREEN
 sharing_screen = False
 watching_stream = False
+protocol_version = protocol.PROTOCOL_V1  # switched to v2 if the server accepts it in the handshake
 
 
 def safe_print(message) -> None:
@@ -47,20 +57,68 @@ def get_input_thread() -> None:
             input_queue.put(user_input)
 
 
+def capture_frames_thread(uuid) -> None:
+    """Captures and encodes frames at TARGET_FPS while sharing, keeping only the newest one for the network loop."""
+    while sharing_screen:
+        started = time.monotonic()
+        if ADAPTIVE_BITRATE:
+            encoded_frame = ScreenShareManager.capture_frame(bitrate_controller.quality, bitrate_controller.scale)
+            frame_interval = 1 / bitrate_controller.fps
+        else:
+            encoded_frame = ScreenShareManager.capture_frame()
+            frame_interval = 1 / TARGET_FPS
+        is_keyframe = encoded_frame[:len(protocol.FRAME_DELTA_MAGIC)] != protocol.FRAME_DELTA_MAGIC
+        message = None
+        try:
+            # The network loop did not get to it, the new frame replaces it. A delta never replaces a
+            # waiting keyframe: it is drawn on that keyframe, so the delta is dropped instead.
+            waiting = frame_slot.get_nowait()
+            bitrate_controller.on_local_drop()
+            if waiting[1] and not is_keyframe:
+                message, is_keyframe = waiting
+        except queue.Empty:
+            pass
+        if message is None:
+            message = protocol.create_message(f"{uuid}|{MESSAGE_TYPES['Binary']}|".encode() + encoded_frame,
+                                              protocol_version, MESSAGE_TYPES['Binary'])
+        frame_slot.put((message, is_keyframe))
+        wakeup_sender.send(b"\0")  # wake the network loop out of select
+        time.sleep(max(0.0, frame_interval - (time.monotonic() - started)))
+
+
+def next_outgoing_message(outgoing) -> memoryview | None:
+    """Commands go out before frames."""
+    if outgoing:
+        return memoryview(outgoing.popleft())
+    try:
+        return memoryview(frame_slot.get_nowait()[0])
+    except queue.Empty:
+        return None
+
+
 def handle_requests(client_socket, uuid) -> None:
     global pending_for_start, pending_for_join, sharing_screen, watching_stream
     threading.Thread(target=get_input_thread, daemon=True).start()  # Start input thread
+    capture_thread = None
+    decoder = protocol.MessageDecoder(protocol_version)
+    outgoing = deque()  # commands waiting for the socket
+    sending = None  # unsent part of the message currently being sent
+    client_socket.setblocking(False)
 
     while True:
-        # Check for data from server
-        rlist, _, _ = select.select([client_socket], [], [], 0.2)
-        if rlist:
+        # Check for data from server, and for room to send if something is waiting
+        has_outgoing = sending is not None or outgoing or not frame_slot.empty()
+        rlist, wlist, _ = select.select([client_socket, wakeup_receiver], [client_socket] if has_outgoing else [],
+                                        [], 0.2)
+        if wakeup_receiver in rlist:
+            wakeup_receiver.recv(1024)
+        if client_socket in rlist:
             try:
-                response = protocol.get_analyzed_data(client_socket)
-                if response == b"":
+                if not decoder.recv_from(client_socket):
                     safe_print("Server closed.")
                     break
-                handle_response(response)
+                for response in decoder.messages():
+                    handle_response(response)
             except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
                 client_socket.close()
                 safe_print("Error : Connection Shutdown.")
@@ -69,11 +127,19 @@ def handle_requests(client_socket, uuid) -> None:
                 safe_print(f"Unexpected error: {e}")
                 break
 
-        if sharing_screen:
-            encoded_frame = ScreenShareManager.capture_frame()
-            message = protocol.create_message(f"{uuid}|{MESSAGE_TYPES['Binary']}|".encode() + encoded_frame)
+        if sharing_screen and (capture_thread is None or not capture_thread.is_alive()):
+            capture_thread = threading.Thread(target=capture_frames_thread, args=(uuid,), daemon=True)
+            capture_thread.start()
+
+        if client_socket in wlist:
+            if sending is None:
+                sending = next_outgoing_message(outgoing)
             try:
-                client_socket.send(message)
+                if sending is not None:
+                    sent = client_socket.send(sending)
+                    sending = sending[sent:] if sent < len(sending) else None
+            except BlockingIOError:
+                pass
             except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
                 client_socket.close()
                 safe_print("Error : Connection Shutdown.")
@@ -86,9 +152,13 @@ def handle_requests(client_socket, uuid) -> None:
         if not input_queue.empty():
             client_input = input_queue.get()
             if client_input == "" or client_input == 'QUIT':
-                # Quit command
-                message = protocol.create_message(f"{uuid}|{MESSAGE_TYPES['Text']}|QUIT|")
-                client_socket.send(message)
+                # Quit command, sent right after whatever message is halfway out
+                sharing_screen = False
+                message = protocol.create_message(f"{uuid}|{MESSAGE_TYPES['Text']}|QUIT|", protocol_version)
+                client_socket.setblocking(True)
+                if sending is not None:
+                    client_socket.sendall(sending)
+                client_socket.sendall(message)
                 break
 
             # Extract command and message content
@@ -98,16 +168,11 @@ def handle_requests(client_socket, uuid) -> None:
                     pending_for_start = True
                 if command == "JOIN_SHARE_SCREEN":
                     pending_for_join = True
-                message = protocol.create_message(f"{uuid}|{MESSAGE_TYPES['Text']}|{command}|{content}")
-                try:
-                    client_socket.send(message)
-                except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
-                    client_socket.close()
-                    safe_print("Error : Connection Shutdown.")
-                    break
-                except Exception as e:
-                    safe_print(f"Unexpected error: {e}")
-                    break
+                if command == "END_SHARE_SCREEN":
+                    sharing_screen = False  # stops the capture thread
+                message = protocol.create_message(f"{uuid}|{MESSAGE_TYPES['Text']}|{command}|{content}",
+                                                  protocol_version)
+                outgoing.append(message)
 
     safe_print("Connection closed")
 
@@ -165,6 +230,7 @@ def handle_response(response) -> None:
         if content == b"CONFIRM_START":
             pending_for_start = False
             sharing_screen = True
+            ScreenShareManager.request_keyframe()
             safe_print("Screen sharing started.")
 
         elif content == b"DENIED_START":
@@ -174,6 +240,7 @@ def handle_response(response) -> None:
         elif content == b"CONFIRM_JOIN":
             pending_for_join = False
             watching_stream = True
+            ScreenShareManager.reset_canvas()
             cv2.namedWindow('Screen_Capture_Window', cv2.WINDOW_NORMAL)
             safe_print("Joined screen sharing session.")
 
@@ -183,10 +250,19 @@ def handle_response(response) -> None:
 
         elif content == b"DISCONNECT":
             watching_stream = False
+            ScreenShareManager.reset_canvas()
             cv2.destroyAllWindows()
 
+        elif content == b"REQUEST_KEYFRAME":
+            ScreenShareManager.request_keyframe()
+
+        elif content.startswith(b"STREAM_STATS|"):
+            _, watcher_queued_bytes, frames_dropped = content.split(b"|")
+            bitrate_controller.on_server_report(int(watcher_queued_bytes), int(frames_dropped))
+
 
 def main() -> None:
+    global protocol_version
     username = input("To join chat, type username (Only alphabetic or numbers): ")
     while not username.isalnum():
         username = input("To join chat, type username (Only alphabetic or numbers): ")
@@ -196,10 +272,11 @@ def main() -> None:
     client_socket.connect((protocol.SERVER_IP, protocol.SERVER_PORT))
     print(f"Connected to {protocol.SERVER_IP} on port {protocol.SERVER_PORT}...")
 
-    # Send username to server for initial registration
-    initial_message = protocol.create_message(username)
+    # Send username to server for initial registration, asking for the binary protocol
+    initial_message = protocol.create_handshake(username)
     client_socket.send(initial_message)
-    uuid = protocol.get_analyzed_data(client_socket).decode()
+    uuid, capabilities = protocol.parse_handshake_reply(protocol.get_analyzed_data(client_socket))
+    protocol_version = protocol.get_protocol_version(capabilities)
     print(f"Your assigned UUID: {uuid}")
     print("Commands:\n"
           "     SEND_MESSAGE - Send message (e.g., SEND_MESSAGE Hello)\n"
@@ -208,10 +285,15 @@ def main() -> None:
           "(Only if admin or owner) (e.g., CHANGE_STATUS 2RegularUserName)\n"
           "     KICK_USER - Kick user (Only if admin or owner) (e.g., KICK_USER UserName)\n"
           "     SEND_PRIVATE_MESSAGE - Send private message (e.g., SEND_PRIVATE_MESSAGE RecipientName|Hello)\n"
-          "     START_SHARE_SCREEN - Starts share-screen that people can join to watch (e.g., START_SHARE_SCREEN)\n"
+          "     START_SHARE_SCREEN - Starts share-screen that people can join to watch, optionally only members "
+          "of a room you are in (e.g., START_SHARE_SCREEN or START_SHARE_SCREEN RoomName)\n"
           "     END_SHARE_SCREEN - Ends share-screen (e.g., END_SHARE_SCREEN)\n"
           "     JOIN_SHARE_SCREEN - Joins a share-screen of user (e.g., JOIN_SHARE_SCREEN ScreenSharerUserName)\n"
           "     LEAVE_SHARE_SCREEN - Leaves a share-screen user currently watch (e.g., LEAVE_SHARE_SCREEN)\n"
+          "     JOIN_ROOM - Joins a room, creating it if needed (e.g., JOIN_ROOM RoomName)\n"
+          "     LEAVE_ROOM - Leaves a room (e.g., LEAVE_ROOM RoomName)\n"
+          "     ROOM_MESSAGE - Send message to the members of a room you are in (e.g., ROOM_MESSAGE RoomName|Hello)\n"
+          "     STATS - Shows the server metrics (Only if admin or owner) (e.g., STATS)\n"
           "     QUIT - Quit (QUIT or press Enter)\n")
     # Enter the main request-handling loop
     handle_requests(client_socket, uuid)
@@ -0,0 +1,332 @@
+import json
+import logging
+import selectors
+import socket
+import struct
+from abc import ABC, abstractmethod
+from typing import Optional, Callable
+import metrics
+import protocol
+from user import OutboundQueue, SlowConsumerPolicy, UserStatus, SYSTEM, TEXT
+
+# Events between nodes are v2 framed: the length of a JSON header, the header, then a binary body
+# such as a frame or a message another node already rendered. The header names the sending node,
+# and "to" lists the receiving nodes when the event is not for all of them.
+EVENT_HEADER_LENGTH = struct.Struct("!I")
+MAX_EVENT_SIZE = protocol.MAX_MESSAGE_SIZE + 64 * 1024
+PEER_QUEUE_MESSAGES = 100_000
+PEER_QUEUE_BYTES = 64 * 1024 * 1024
+PEER_FRAME_BACKLOG = 8 * 1024 * 1024  # delta frames to a node are dropped while this much is waiting
+SEND_BATCH_MESSAGES = 64
+SEND_BATCH_BYTES = 1024 * 1024
+CONTROL_LANE = SYSTEM  # presence, chat and commands overtake frames
+FRAME_LANE = TEXT
+
+# No bus means a single node, and every function here does nothing.
+bus = None
+node_id = None
+selector: Optional[selectors.BaseSelector] = None
+# Called with (header, body) for the events that touch local users, set by the server.
+on_event: Optional[Callable[[dict, bytes], None]] = None
+
+remote_users = {}  # user id -> RemoteUser
+remote_users_by_name = {}
+# Id of a local sharer -> nodes with watchers of it, each node gets one copy of every frame.
+remote_watcher_nodes = {}
+events_dropped = metrics.counter("chat_peer_events_dropped_total", "Events not queued to another node.",
+                                 ("reason",))
+events_failed = metrics.counter("chat_peer_events_failed_total", "Events from another node that could not be handled.")
+
+
+class RemoteUser:
+    """
+    A user connected to another node. It has the same sharing and watching methods as User, so the
+    server handlers work on it unchanged. watchers holds the local users watching it.
+    """
+
+    __slots__ = ("id", "name", "node_id", "status", "is_sharing_screen", "share_room", "watchers")
+
+    def __init__(self, user_id, name, node, status=UserStatus.RegularUser, is_sharing_screen=False, share_room=None):
+        self.id = user_id
+        self.name = name
+        self.node_id = node
+        self.status = status
+        self.is_sharing_screen = is_sharing_screen
+        self.share_room = share_room
+        self.watchers = {}  # used as an insertion-ordered set, values are None
+
+    def __repr__(self):
+        return f"RemoteUser({self.name}, {self.node_id}, {self.id})"
+
+    def is_user_watching_stream(self, user):
+        return user in self.watchers
+
+    def add_user_to_watchers_list(self, user):
+        if not self.watchers:
+            send_to(self.node_id, "watch", sharer_id=self.id)
+        self.watchers[user] = None
+
+    def remove_user_from_watchers_list(self, user):
+        del self.watchers[user]
+        if not self.watchers:
+            send_to(self.node_id, "unwatch", sharer_id=self.id)
+
+
+class PeerConnection:
+    """Socket to another node. Events wait in an OutboundQueue and go out whenever the socket takes them."""
+
+    __slots__ = ("node_id", "sock", "decoder", "queue")
+
+    def __init__(self, node, sock):
+        self.node_id = node
+        self.sock = sock
+        self.decoder = protocol.MessageDecoder(protocol.PROTOCOL_V2, MAX_EVENT_SIZE)
+        self.queue = OutboundQueue(PEER_QUEUE_MESSAGES, PEER_QUEUE_BYTES, SlowConsumerPolicy.DropNewest)
+        sock.setblocking(False)
+
+    def send(self, wire_bytes, lane=CONTROL_LANE, droppable=False):
+        if droppable and self.queue.queued_bytes > PEER_FRAME_BACKLOG:
+            events_dropped.inc("frame_backlog")
+            return
+        if not self.queue.push(wire_bytes, lane):
+            events_dropped.inc("queue_full")
+            logging.warning(f"Queue to node {self.node_id} is full. Dropping event.")
+            return
+        if selector is not None and not selector.get_key(self.sock).events & selectors.EVENT_WRITE:
+            selector.modify(self.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self.handle_io)
+
+    def handle_io(self, sock, events) -> None:
+        """Selector callback."""
+        try:
+            if events & selectors.EVENT_READ:
+                if not self.decoder.recv_from(sock):
+                    logging.error(f"Node {self.node_id} closed the connection")
+                    drop_connection(self)
+                    return
+                for data in self.decoder.messages():
+                    try:
+                        handle_event(*decode_event(data))
+                    except Exception as e:
+                        # A bad or newer event only loses itself, the link and the loop go on
+                        events_failed.inc()
+                        logging.error(f"Cannot handle an event from node {self.node_id}: {e!r}")
+            if events & selectors.EVENT_WRITE:
+                self.queue.flush(sock, SEND_BATCH_MESSAGES, SEND_BATCH_BYTES)
+                if len(self.queue) == 0:
+                    selector.modify(sock, selectors.EVENT_READ, self.handle_io)
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, ValueError) as e:
+            logging.error(f"Connection to node {self.node_id} failed: {e}")
+            drop_connection(self)
+
+
+class MessageBus(ABC):
+    """
+    How events reach the other nodes. connections maps a name to each PeerConnection the bus uses,
+    they are registered in the server's selector by start().
+    """
+
+    connections: dict
+
+    @abstractmethod
+    def send(self, wire_bytes, nodes=None, lane=CONTROL_LANE, droppable=False):
+        """Sends an event to the given nodes, or to every other node if nodes is None."""
+
+    @abstractmethod
+    def remove(self, connection):
+        """Forgets a closed connection. Returns the nodes that became unreachable, None for all of them."""
+
+
+class ShardBus(MessageBus):
+    """Full mesh between the shards of one host, one connected socket per pair of shards."""
+
+    def __init__(self, peer_sockets):
+        self.connections = {node: PeerConnection(node, sock) for node, sock in peer_sockets.items()}
+
+    def send(self, wire_bytes, nodes=None, lane=CONTROL_LANE, droppable=False):
+        if nodes is None:
+            nodes = self.connections
+        for node in nodes:
+            connection = self.connections.get(node)
+            if connection is not None:
+                connection.send(wire_bytes, lane, droppable)
+
+    def remove(self, connection):
+        self.connections.pop(connection.node_id, None)
+        return [connection.node_id]
+
+
+class BrokerBus(MessageBus):
+    """
+    A single connection to a broker that forwards every event to the nodes it is for, see broker.py.
+    Each event is sent once whatever the number of nodes, the broker does the fan-out.
+    """
+
+    def __init__(self, sock):
+        self.connections = {"broker": PeerConnection("broker", sock)}
+
+    @classmethod
+    def connect(cls, address):
+        return cls(socket.create_connection(address))
+
+    def send(self, wire_bytes, nodes=None, lane=CONTROL_LANE, droppable=False):
+        connection = self.connections.get("broker")
+        if connection is not None:
+            connection.send(wire_bytes, lane, droppable)
+
+    def remove(self, connection):
+        self.connections.clear()
+        return None
+
+
+def start(new_bus, new_node_id, new_selector, event_handler) -> None:
+    """Joins the other nodes. Their users are announced in reply to our hello."""
+    global bus, node_id, selector, on_event
+    bus, node_id, selector, on_event = new_bus, new_node_id, new_selector, event_handler
+    for connection in bus.connections.values():
+        selector.register(connection.sock, selectors.EVENT_READ, connection.handle_io)
+    publish("hello")
+
+
+def drop_connection(connection) -> None:
+    try:
+        selector.unregister(connection.sock)
+    except (KeyError, ValueError):
+        pass
+    connection.sock.close()
+    nodes = bus.remove(connection)
+    if nodes is None:
+        nodes = {remote_user.node_id for remote_user in remote_users.values()}
+    for node in nodes:
+        on_event({"event": "node_lost", "node": node}, b"")
+
+
+def encode_event(event, body=b"", **fields):
+    """fields may override node, for a broker speaking about a node that went away."""
+    header = json.dumps({"event": event, "node": node_id, **fields}).encode()
+    return protocol.create_message(EVENT_HEADER_LENGTH.pack(len(header)) + header + body, protocol.PROTOCOL_V2)
+
+
+def decode_event_header(data):
+    """Returns the header and where the body starts, without touching the body."""
+    header_length, = EVENT_HEADER_LENGTH.unpack_from(data)
+    header_end = EVENT_HEADER_LENGTH.size + header_length
+    return json.loads(data[EVENT_HEADER_LENGTH.size:header_end]), header_end
+
+
+def decode_event(data):
+    header, header_end = decode_event_header(data)
+    return header, data[header_end:]
+
+
+def publish(event, body=b"", **fields) -> None:
+    if bus is not None:
+        bus.send(encode_event(event, body, **fields))
+
+
+def send_to(node, event, body=b"", **fields) -> None:
+    if bus is not None:
+        bus.send(encode_event(event, body, to=[node], **fields), [node])
+
+
+def rendered(message_obj):
+    content = message_obj.create_message()
+    return content.encode() if type(content) is str else content
+
+
+def broadcast(message_obj, history=False) -> None:
+    """Hands a message for every user to the other nodes, rendered once here. history asks them to record it."""
+    if bus is not None:
+        publish("broadcast", rendered(message_obj), message_type=message_obj.message_type, history=history)
+
+
+def broadcast_to_room(room, message_obj) -> None:
+    """Room members are only known to their own node, so every node gets the message and picks its members."""
+    if bus is not None:
+        publish("room_broadcast", rendered(message_obj), room=room, message_type=message_obj.message_type)
+
+
+def deliver(remote_user, message_obj) -> None:
+    send_to(remote_user.node_id, "deliver", rendered(message_obj), user_id=remote_user.id,
+            message_type=message_obj.message_type)
+
+
+def relay_frame(sharer, frame_obj) -> None:
+    """Sends a frame once to every node with watchers of the sharer. Deltas are dropped for a backlogged node."""
+    nodes = remote_watcher_nodes.get(sharer.id)
+    if not nodes or bus is None:
+        return
+    nodes = list(nodes)
+    wire_bytes = encode_event("frame", frame_obj.content, to=nodes, sharer_id=sharer.id,
+                              keyframe=frame_obj.is_keyframe)
+    bus.send(wire_bytes, nodes, FRAME_LANE, droppable=not frame_obj.is_keyframe)
+
+
+def announce_user(user, node=None) -> None:
+    fields = {"user_id": user.id, "name": user.name, "status": user.status.value, "sharing": user.is_sharing_screen,
+              "share_room": user.share_room}
+    if node is None:
+        publish("user_joined", **fields)
+    else:
+        send_to(node, "user_joined", **fields)
+
+
+def get_remote_user(user_id) -> Optional[RemoteUser]:
+    return remote_users.get(user_id)
+
+
+def get_remote_user_by_name(name) -> Optional[RemoteUser]:
+    return remote_users_by_name.get(name)
+
+
+def has_remote_users() -> bool:
+    return bool(remote_users)
+
+
+def add_remote_user(user_id, name, node, status, is_sharing_screen, share_room=None) -> None:
+    remote_user = RemoteUser(user_id, name, node, status, is_sharing_screen, share_room)
+    remote_users[user_id] = remote_user
+    remote_users_by_name[name] = remote_user
+
+
+def remove_remote_user(user_id) -> Optional[RemoteUser]:
+    remote_user = remote_users.pop(user_id, None)
+    if remote_user is not None and remote_users_by_name.get(remote_user.name) is remote_user:
+        del remote_users_by_name[remote_user.name]
+    return remote_user
+
+
+def remove_node_users(node):
+    """Forgets everything about a node that went away. Returns its users."""
+    for nodes in remote_watcher_nodes.values():
+        nodes.discard(node)
+    return [remove_remote_user(user.id) for user in list(remote_users.values()) if user.node_id == node]
+
+
+def handle_event(header, body) -> None:
+    """Keeps the mirror of other nodes' users up to date, and passes every other event to the server."""
+    event = header["event"]
+    remote_user = remote_users.get(header.get("user_id"))
+    if event == "user_joined":
+        add_remote_user(header["user_id"], header["name"], header["node"], UserStatus(header["status"]),
+                        header["sharing"], header.get("share_room"))
+    elif event == "user_renamed":
+        if remote_user is not None:
+            remove_remote_user(remote_user.id)
+            remote_user.name = header["name"]
+            remote_users[remote_user.id] = remote_user
+            remote_users_by_name[remote_user.name] = remote_user
+    elif event == "status_changed":
+        if remote_user is not None:
+            remote_user.status = UserStatus(header["status"])
+    elif event == "share_started":
+        if remote_user is not None:
+            remote_user.is_sharing_screen = True
+            remote_user.share_room = header.get("share_room")
+    elif event == "watch":
+        remote_watcher_nodes.setdefault(header["sharer_id"], set()).add(header["node"])
+    elif event == "unwatch":
+        nodes = remote_watcher_nodes.get(header["sharer_id"])
+        if nodes is not None:
+            nodes.discard(header["node"])
+    elif on_event is not None:
+        on_event(header, body)
@@ -0,0 +1,39 @@
+import socket
+import sys
+import broker
+import cluster
+import history
+import protocol
+import server
+import serverlog
+
+
+def main() -> None:
+    """
+    Runs one node of a federation: python federatedserver.py [port] [broker host] [broker port].
+    Every node connects to the broker, and a load balancer spreads the clients between the nodes.
+    """
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else protocol.SERVER_PORT
+    broker_address = (sys.argv[2] if len(sys.argv) > 2 else broker.BROKER_HOST,
+                      int(sys.argv[3]) if len(sys.argv) > 3 else broker.BROKER_PORT)
+    node_id = f"{socket.gethostname()}:{port}"
+
+    print("Setting up server...")
+    server_socket = server.create_server_socket(port=port)
+    serverlog.setup(f'log_node{port}.log')
+    try:
+        bus = cluster.BrokerBus.connect(broker_address)
+    except OSError as e:
+        print(f"Cannot reach the broker at {broker_address}: {e}")
+        server_socket.close()
+        serverlog.stop()
+        return
+    server.open_history(f"{history.HISTORY_DIR}_node{port}")
+    server.open_metrics_endpoint(f"metrics_node{port}.sock")
+    cluster.start(bus, node_id, server.selector, server.handle_cluster_event)
+    print(f"Node {node_id} listening for clients...")
+    server.serve(server_socket)
+
+
+if __name__ == '__main__':
+    main()
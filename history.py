@@ -0,0 +1,167 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+HISTORY_DIR = "history"
+SEGMENT_SIZE = 64 * 1024 * 1024  # bytes of records before a new segment is started
+FSYNC_INTERVAL = 1.0  # seconds between writes of the buffered records
+REPLAY_COUNT = 50  # records a new user gets when it asks for no timestamp
+MAX_REPLAY_COUNT = 200  # cap for a replay since a timestamp, below the outbound queue size
+RECORD_HEADER = struct.Struct("!dI")  # unix time, payload length
+INDEX_ENTRY = struct.Struct("!dQ")  # unix time, offset of the record in the segment's log file
+
+
+class HistoryLog:
+    """
+    Append-only chat history split in segments. NNNNNNNN.log holds the records and NNNNNNNN.idx one
+    fixed size entry per record, read through mmap to find where a replay starts without reading the
+    records before it. append() only buffers; a background thread writes the buffered records and
+    fsyncs every fsync_interval seconds, so the event loop never waits for the disk.
+    """
+
+    def __init__(self, directory=HISTORY_DIR, fsync_interval=FSYNC_INTERVAL, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        # Held only to hand records from append() to the writer and to publish what the writer wrote, so
+        # a replay sees every record once: in _pending, in _writing, or counted in _segments.
+        self._lock = threading.Lock()
+        self._pending = []  # (unix time, payload) not written yet
+        self._writing = []  # records the writer thread is writing, until they are counted in _segments
+        self._segments = []  # [segment number, index entries] from the oldest, as far as flushed to the files
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".idx"):
+                entries = os.path.getsize(os.path.join(directory, name)) // INDEX_ENTRY.size
+                self._segments.append([int(name[:-4]), entries])
+        if not self._segments:
+            self._segments.append([0, 0])
+        # Segment the writer appends to and its entries, ahead of _segments while a flush is in progress
+        self._segment, self._segment_entries = self._segments[-1]
+        self._open_segment()
+        self._closed = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def _path(self, segment, extension):
+        return os.path.join(self.directory, f"{segment:08d}.{extension}")
+
+    def _open_segment(self):
+        self._log_file = open(self._path(self._segment, "log"), "ab")
+        self._index_file = open(self._path(self._segment, "idx"), "ab")
+        self._log_size = self._log_file.tell()
+        # An index entry cut by a crash is dropped, new entries must start at an entry boundary
+        self._index_file.truncate(self._segment_entries * INDEX_ENTRY.size)
+
+    def append(self, payload) -> None:
+        with self._lock:
+            self._pending.append((time.time(), bytes(payload)))
+
+    def _write_loop(self) -> None:
+        while not self._closed.wait(self.fsync_interval):
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the buffered records. The disk is only touched outside the lock, so append() never waits for it."""
+        with self._lock:
+            if not self._pending:
+                return
+            self._writing, self._pending = self._pending, []
+        written = []  # (segment, entries) to publish, a segment per roll and the current one last
+        for timestamp, payload in self._writing:
+            if self._log_size >= self.segment_size:
+                written.append((self._segment, self._segment_entries))
+                self._roll_segment()
+            self._index_file.write(INDEX_ENTRY.pack(timestamp, self._log_size))
+            self._log_file.write(RECORD_HEADER.pack(timestamp, len(payload)))
+            self._log_file.write(payload)
+            self._log_size += RECORD_HEADER.size + len(payload)
+            self._segment_entries += 1
+        written.append((self._segment, self._segment_entries))
+        # Records reach the files before their index entries, so an entry never points past the log
+        self._log_file.flush()
+        self._index_file.flush()
+        with self._lock:
+            for segment, entries in written:
+                if segment == self._segments[-1][0]:
+                    self._segments[-1][1] = entries
+                else:
+                    self._segments.append([segment, entries])
+            self._writing = []
+        os.fsync(self._log_file.fileno())
+        os.fsync(self._index_file.fileno())
+
+    def _roll_segment(self) -> None:
+        self._log_file.flush()
+        self._index_file.flush()
+        os.fsync(self._log_file.fileno())
+        os.fsync(self._index_file.fileno())
+        self._log_file.close()
+        self._index_file.close()
+        self._segment += 1
+        self._segment_entries = 0
+        self._open_segment()
+
+    def replay(self, count=REPLAY_COUNT, since=None):
+        """
+        Yields the payloads of the last count records, or of the records written since a unix time
+        (at most MAX_REPLAY_COUNT of the newest), oldest first. Records are read from the files one at a time.
+        """
+        limit = count if since is None else MAX_REPLAY_COUNT
+        with self._lock:
+            pending = [payload for timestamp, payload in self._writing + self._pending
+                       if since is None or timestamp >= since]
+            segments = [tuple(segment) for segment in self._segments]
+        pending = pending[-limit:] if limit > 0 else []
+        remaining = limit - len(pending)
+        ranges = []  # (segment, first entry, end entry) from the newest segment
+        for segment, entries in reversed(segments):
+            if remaining <= 0:
+                break
+            if entries == 0:
+                continue
+            start = max(0, entries - remaining)
+            if since is not None:
+                start = max(start, self._find_entry(segment, entries, since))
+            if start < entries:
+                ranges.append((segment, start, entries))
+                remaining -= entries - start
+            if since is not None and start > 0:
+                break  # the older segments only hold records from before since
+        for segment, start, end in reversed(ranges):
+            yield from self._read_records(segment, start, end)
+        yield from pending
+
+    def _find_entry(self, segment, entries, since):
+        """Binary search over the mmapped index for the first record written at or after since."""
+        with open(self._path(segment, "idx"), "rb") as index_file, \
+                mmap.mmap(index_file.fileno(), entries * INDEX_ENTRY.size, access=mmap.ACCESS_READ) as index:
+            low, high = 0, entries
+            while low < high:
+                middle = (low + high) // 2
+                timestamp, _ = INDEX_ENTRY.unpack_from(index, middle * INDEX_ENTRY.size)
+                if timestamp < since:
+                    low = middle + 1
+                else:
+                    high = middle
+            return low
+
+    def _read_records(self, segment, start, end):
+        with open(self._path(segment, "idx"), "rb") as index_file, \
+                open(self._path(segment, "log"), "rb") as log_file, \
+                mmap.mmap(index_file.fileno(), end * INDEX_ENTRY.size, access=mmap.ACCESS_READ) as index, \
+                mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            for entry in range(start, end):
+                _, offset = INDEX_ENTRY.unpack_from(index, entry * INDEX_ENTRY.size)
+                _, length = RECORD_HEADER.unpack_from(log, offset)
+                payload_start = offset + RECORD_HEADER.size
+                yield log[payload_start:payload_start + length]
+
+    def close(self) -> None:
+        self._closed.set()
+        self._writer.join()
+        self.flush()
+        self._log_file.close()
+        self._index_file.close()
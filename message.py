@@ -1,5 +1,6 @@
 import datetime
 from abc import ABC, abstractmethod
+import protocol
 
 
 class Message(ABC):
@@ -10,11 +11,23 @@ class Message(ABC):
     def __init__(self, content, message_type):
         self.content = content
         self.message_type = message_type
+        self._wire_bytes = {}  # (protocol version, compressed) -> framed message
 
     @abstractmethod
     def create_message(self):
         return f"{self.message_type}|{self.content}"
 
+    def get_wire_bytes(self, version=protocol.PROTOCOL_V1, compress=False):
+        """
+        Framed message, built on first use and shared by every recipient using the same protocol version
+        and compression, so a broadcast is compressed once.
+        """
+        wire_bytes = self._wire_bytes.get((version, compress))
+        if wire_bytes is None:
+            wire_bytes = protocol.create_message(self.create_message(), version, self.message_type, compress=compress)
+            self._wire_bytes[(version, compress)] = wire_bytes
+        return wire_bytes
+
 
 class TextMessage(Message):
 
@@ -38,6 +51,17 @@ class ChatMessage(TextMessage):
         return message_build
 
 
+class RoomMessage(ChatMessage):
+
+    def __init__(self, content, message_type, sender, room):
+        super().__init__(content, message_type, sender)
+        self.room = room
+
+    def create_message(self):
+        message_build = f"{self.message_type}|{self.time_of_upload} [{self.room}] {self.sender_name} : {self.content}"
+        return message_build
+
+
 class PrivateMessage(ChatMessage):
 
     def create_message(self):
@@ -56,5 +80,26 @@ class SystemMessage(Message):
 
 class Frame(Message):
 
+    @property
+    def is_keyframe(self):
+        """content may be a memoryview of the received message, which has no startswith."""
+        return self.content[:len(protocol.FRAME_DELTA_MAGIC)] != protocol.FRAME_DELTA_MAGIC
+
     def create_message(self):
         return f"{self.message_type}|".encode() + self.content
+
+    def get_wire_bytes(self, version=protocol.PROTOCOL_V1, compress=False):
+        """Frames are never compressed. In v2 the payload is copied once, straight into the framed buffer."""
+        if version != protocol.PROTOCOL_V2:
+            return super().get_wire_bytes(version)
+        wire_bytes = self._wire_bytes.get((version, False))
+        if wire_bytes is None:
+            wire_bytes = self._wire_bytes[(version, False)] = protocol.create_frame_message(self.content)
+        return wire_bytes
+
+
+class RelayedMessage(Message):
+    """A message another node already rendered, passed on as it is."""
+
+    def create_message(self):
+        return self.content
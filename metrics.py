@@ -0,0 +1,177 @@
+import os
+import socket
+import time
+from bisect import bisect_left
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+SCRAPE_TIMEOUT = 1.0  # seconds a scraper gets to send its request and read the response
+MAX_REQUEST_SIZE = 8 * 1024
+# Upper bounds in seconds, from the cost of a short command to a slow fan-out.
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Counter:
+    __slots__ = ("name", "help", "label_names", "values")
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.values = {}  # label values -> value
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, self.label_names, label_values, value
+
+
+class Gauge(Counter):
+    """Either set by the code, or read from collect() at every scrape so the hot paths pay nothing."""
+
+    __slots__ = ("collect",)
+    kind = "gauge"
+
+    def __init__(self, name, help_text, label_names=(), collect=None):
+        super().__init__(name, help_text, label_names)
+        self.collect = collect
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def samples(self):
+        values = self.collect() if self.collect is not None else self.values
+        for label_values, value in values.items():
+            yield self.name, self.label_names, label_values, value
+
+
+class Histogram:
+    """Fixed buckets, so an observation is one bisect and three additions."""
+
+    __slots__ = ("name", "help", "label_names", "buckets", "series")
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}  # label values -> [per bucket counts with +Inf last, sum, count]
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        label_names = self.label_names + ("le",)
+        for label_values, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", label_names, label_values + (str(bound),), cumulative
+            yield f"{self.name}_sum", self.label_names, label_values, total
+            yield f"{self.name}_count", self.label_names, label_values, count
+
+
+# Every metric of the process, in the order they were created.
+registry = []
+
+
+def counter(name, help_text, label_names=()):
+    metric = Counter(name, help_text, label_names)
+    registry.append(metric)
+    return metric
+
+
+def gauge(name, help_text, label_names=(), collect=None):
+    metric = Gauge(name, help_text, label_names, collect)
+    registry.append(metric)
+    return metric
+
+
+def histogram(name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+    metric = Histogram(name, help_text, label_names, buckets)
+    registry.append(metric)
+    return metric
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, label_names, label_values, value in metric.samples():
+            if label_names:
+                labels = ",".join(f'{label}="{escape_label(label_value)}"'
+                                  for label, label_value in zip(label_names, label_values))
+                lines.append(f"{name}{{{labels}}} {value}")
+            else:
+                lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def http_response(request_head):
+    """Answers GET /metrics with the rendered metrics, anything else with 404."""
+    request_line = request_head.split(b"\r\n", 1)[0].split()
+    if len(request_line) >= 2 and request_line[0] == b"GET" and request_line[1] in (b"/", b"/metrics"):
+        status, content_type, body = "200 OK", "text/plain; version=0.0.4", render().encode()
+    else:
+        status, content_type, body = "404 Not Found", "text/plain", b"Not found\n"
+    return (f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n").encode() + body
+
+
+def create_listener(address):
+    """A (host, port) tuple listens on TCP, a string is the path of a unix socket."""
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.unlink(address)  # left by a server that did not shut down
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(address)
+        listener.listen()
+    else:
+        listener = socket.create_server(address)
+    listener.setblocking(False)
+    return listener
+
+
+class Scrape:
+    """
+    One HTTP exchange on a non-blocking connection: the request is read as it arrives, then the
+    response is sent as the socket takes it, so a slow scraper never makes the server loop wait.
+    """
+
+    __slots__ = ("request_head", "response", "deadline")
+
+    def __init__(self):
+        self.request_head = b""
+        self.response = None  # unsent part of the response, None while the request is being read
+        self.deadline = time.monotonic() + SCRAPE_TIMEOUT
+
+    def receive(self, connection) -> bool:
+        """Reads what arrived, and renders the response once the request is complete. False if the scraper left."""
+        data = connection.recv(MAX_REQUEST_SIZE)
+        if not data:
+            return False
+        self.request_head += data
+        if b"\r\n\r\n" in self.request_head or len(self.request_head) >= MAX_REQUEST_SIZE:
+            self.response = memoryview(http_response(self.request_head))
+        return True
+
+    def send(self, connection) -> bool:
+        """Sends what the socket takes. True once the whole response is sent."""
+        sent = connection.send(self.response)
+        self.response = self.response[sent:]
+        return not self.response
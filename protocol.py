@@ -1,4 +1,8 @@
+import asyncio
 import base64
+import struct
+import threading
+import zlib
 
 
 SERVER_PORT = 5555
@@ -6,15 +10,200 @@ SERVER_PORT = 5555
 SERVER_IP = "192.168.1.154"
 DELIMITER = "|"
 
+PROTOCOL_V1 = 1  # "<ascii length>|<base64 payload>"
+PROTOCOL_V2 = 2  # fixed binary header followed by the raw payload
+V2_HEADER = struct.Struct("!IBB")  # payload length, message type, flags
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # payload bytes, bigger messages are rejected before being buffered
+MAX_V1_LENGTH_DIGITS = 10
+RECV_SIZE = 64 * 1024
+FRAME_DELTA_MAGIC = b"DT"  # start of a screen-share frame holding changed tiles, keyframes are plain JPEG
+CAPABILITY_SEPARATOR = ","
+CAPABILITY_V2 = "v2"
+CAPABILITY_ZLIB = "zlib"  # v2 payloads may be compressed, marked by FLAG_COMPRESSED
+SUPPORTED_CAPABILITIES = {CAPABILITY_V2, CAPABILITY_ZLIB}
+FLAG_COMPRESSED = 0x01
+COMPRESSION_THRESHOLD = 32  # payload bytes, shorter ones gain too little to be worth compressing
+COMPRESSION_LEVEL = 6
+COMPRESSION_MEM_LEVEL = 4  # the default 8 allocates enough state per call to cost more than the compressing
+BINARY_TYPE = 1  # screen-share frames are JPEG, they are never compressed again
+FRAME_PREFIX = b"1|"  # message type field in front of a frame's payload
+# Preset dictionary for raw deflate, shared by both ends. Even a one line chat message finds most of
+# its framing in it, so messages can be compressed one at a time and still shrink.
+COMPRESSION_DICTIONARY = (b"STREAM_STATS|REQUEST_KEYFRAME|CONFIRM_JOIN|CONFIRM_START|DISCONNECT|DENIED_JOIN|"
+                          b"0|Error: Not enough permissions.0|Error: Recipient not found. status changed to "
+                          b"UserStatus.RegularUser UserStatus.Administrator UserStatus.Owner has been promoted "
+                          b"to Owner. was kicked by  joined stream. left stream. ended stream. joined room "
+                          b" left room  joined the chat. left the chat.0|Private Message From  : the you and "
+                          b"that is what this have for with not are but just know can will when ok yes lol "
+                          b"http://https://www. .com thanks please hello hi ")
+HISTORY_SINCE = "since="  # handshake field asking for the chat history since a unix time, not the last messages
+
+
+class MessageTooLargeError(ValueError):
+    pass
+
+
+def check_message_size(size, max_message_size, version=PROTOCOL_V1):
+    if size < 0:
+        raise ValueError(f"Negative message length {size}")
+    if version == PROTOCOL_V1:
+        size = size // 4 * 3  # base64 length to payload length
+    if size > max_message_size:
+        raise MessageTooLargeError(f"Message of {size} bytes is over the {max_message_size} bytes limit")
+
+
+def parse_v1_length(field):
+    """The ASCII length in front of a v1 message. int() alone would also accept "-5", "+5", " 5" or "1_0"."""
+    if not field or not field.isdigit():
+        raise ValueError(f"Invalid message length {bytes(field)!r}")
+    return int(field)
+
+
+# Receive buffer shared by the decoders of a thread, so an idle connection holds no buffer of its own.
+_scratch = threading.local()
+
+
+def _scratch_buffer():
+    buffer = getattr(_scratch, "buffer", None)
+    if buffer is None:
+        buffer = _scratch.buffer = memoryview(bytearray(RECV_SIZE))
+    return buffer
+
+
+class MessageDecoder:
+    """
+    Incremental decoder for one connection. recv_from reads whatever the socket has without blocking,
+    messages() hands out every message that is complete so far and keeps the rest for the next read.
+    Reads go through a buffer shared by the thread's decoders; a connection only keeps the bytes of a
+    partial message, and the rest of a big message is read straight into its own buffer.
+    """
+
+    def __init__(self, version=PROTOCOL_V1, max_message_size=MAX_MESSAGE_SIZE, recv_size=RECV_SIZE):
+        self.version = version
+        self.max_message_size = max_message_size
+        self.recv_size = min(recv_size, RECV_SIZE)  # bytes asked for per read
+        self._buffer = bytearray()  # unparsed bytes, released once they are all parsed
+        self._start = 0  # first unparsed byte
+        self._end = 0  # end of received data
+        self._needed = 0  # size of the message being received, once its header was parsed
+
+    def recv_from(self, sock):
+        """Reads once from a non-blocking socket. Returns False if the peer closed the connection."""
+        missing = self._needed - (self._end - self._start)
+        try:
+            if missing > self.recv_size:
+                self._make_room(missing)
+                received = sock.recv_into(memoryview(self._buffer)[self._end:])
+            else:
+                scratch = _scratch_buffer()
+                received = sock.recv_into(scratch, self.recv_size)
+                if received:
+                    self._compact()
+                    del self._buffer[self._end:]
+                    self._buffer += scratch[:received]
+        except BlockingIOError:
+            return True
+        if received == 0:
+            return False
+        self._end += received
+        return True
+
+    def feed(self, data):
+        self._make_room(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def _compact(self):
+        """Moves unparsed data to the front."""
+        if self._start > 0:
+            pending = self._end - self._start
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+
+    def _make_room(self, size):
+        """Moves unparsed data to the front, and grows the buffer so size more bytes and a whole pending message fit."""
+        self._compact()
+        capacity = max(self._end + size, self._needed)
+        if capacity > len(self._buffer):
+            self._buffer.extend(bytes(capacity - len(self._buffer)))
+        elif len(self._buffer) > 4 * capacity:
+            del self._buffer[capacity:]  # give back the memory of a big message that was already handled
+
+    def messages(self):
+        while True:
+            data = self._next_message()
+            if data is None:
+                return
+            yield data
+
+    def _next_message(self):
+        available = self._end - self._start
+        if available == 0:
+            if self._buffer:
+                self._buffer = bytearray()  # an idle connection keeps no memory
+                self._start = self._end = 0
+            return None
+        if self.version == PROTOCOL_V2:
+            if available < V2_HEADER.size:
+                return None
+            datasize, _, flags = V2_HEADER.unpack_from(self._buffer, self._start)
+            check_message_size(datasize, self.max_message_size, self.version)
+            header_size = V2_HEADER.size
+        else:
+            delimiter_index = self._buffer.find(DELIMITER.encode(), self._start,
+                                                min(self._end, self._start + MAX_V1_LENGTH_DIGITS + 1))
+            if delimiter_index == -1:
+                if available > MAX_V1_LENGTH_DIGITS:
+                    raise ValueError("Message length is missing its delimiter")
+                return None
+            datasize = parse_v1_length(self._buffer[self._start:delimiter_index])
+            check_message_size(datasize, self.max_message_size, self.version)
+            header_size = delimiter_index + 1 - self._start
+
+        message_end = self._start + header_size + datasize
+        if message_end > self._end:
+            self._needed = header_size + datasize
+            return None
+        payload_start = self._start + header_size
+        self._start = message_end
+        self._needed = 0
+        with memoryview(self._buffer)[payload_start:message_end] as payload:
+            if self.version == PROTOCOL_V2:
+                if flags & FLAG_COMPRESSED:
+                    return decompress_payload(payload, self.max_message_size)
+                return bytes(payload)
+            return base64.b64decode(payload)
+
+
+def recv_exactly(client_socket, size):
+    """Returns exactly size bytes, or None if the peer closed the connection first."""
+    data = b''
+    while len(data) < size:
+        chunk = client_socket.recv(size - len(data))
+        if chunk == b"":
+            return None
+        data += chunk
+    return data
+
+
+def get_analyzed_data(client_socket, version=PROTOCOL_V1):
+    if version == PROTOCOL_V2:
+        header = recv_exactly(client_socket, V2_HEADER.size)
+        if header is None:
+            return None
+        datasize, _, flags = V2_HEADER.unpack(header)
+        data = recv_exactly(client_socket, datasize)
+        if data is not None and flags & FLAG_COMPRESSED:
+            return decompress_payload(data)
+        return data
 
-def get_analyzed_data(client_socket):
     datasize = client_socket.recv(1)
     if datasize == b"":
         return None
     datasize = datasize.decode()
     while datasize[-1] != DELIMITER:
         datasize += client_socket.recv(1).decode()
-    datasize = int(datasize[:-1])
+    datasize = parse_v1_length(datasize[:-1].encode())
     b64data = b''
     b64data += client_socket.recv(datasize)
     while datasize > len(b64data):
@@ -23,9 +212,113 @@ def get_analyzed_data(client_socket):
     return data
 
 
-def create_message(data):
+async def read_analyzed_data(reader, version=PROTOCOL_V1, max_message_size=MAX_MESSAGE_SIZE):
+    """asyncio version of get_analyzed_data. Returns b"" when the peer closed the connection."""
+    try:
+        if version == PROTOCOL_V2:
+            datasize, _, flags = V2_HEADER.unpack(await reader.readexactly(V2_HEADER.size))
+            check_message_size(datasize, max_message_size, version)
+            data = await reader.readexactly(datasize)
+            if flags & FLAG_COMPRESSED:
+                return decompress_payload(data, max_message_size)
+            return data
+        datasize = parse_v1_length((await reader.readuntil(DELIMITER.encode()))[:-1])
+        check_message_size(datasize, max_message_size, version)
+        b64data = await reader.readexactly(datasize)
+    except asyncio.IncompleteReadError:
+        return b""
+    return base64.b64decode(b64data)
+
+
+def create_message(data, version=PROTOCOL_V1, message_type="0", flags=0, compress=False):
+    """compress asks for a compressed v2 payload, it is sent as it is when compressing does not pay."""
     if type(data) is str:
         data = data.encode()
+    if version == PROTOCOL_V2:
+        if compress and int(message_type) != BINARY_TYPE and len(data) >= COMPRESSION_THRESHOLD:
+            compressed = compress_payload(data)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= FLAG_COMPRESSED
+        return V2_HEADER.pack(len(data), int(message_type), flags) + data
     b64data = base64.b64encode(data)
     return f"{len(b64data)}|".encode() + b64data
 
+
+def create_frame_message(payload):
+    """
+    v2 framed screen-share frame, built in one buffer with a single copy of payload. Returns a read-only
+    memoryview of it, so every watcher's queue can hold the same buffer.
+    """
+    size = len(FRAME_PREFIX) + len(payload)
+    buffer = bytearray(V2_HEADER.size + size)
+    V2_HEADER.pack_into(buffer, 0, size, BINARY_TYPE, 0)
+    payload_start = V2_HEADER.size + len(FRAME_PREFIX)
+    view = memoryview(buffer)
+    view[V2_HEADER.size:payload_start] = FRAME_PREFIX
+    view[payload_start:] = payload  # a bytearray slice assignment would copy payload to a temporary first
+    return view.toreadonly()
+
+
+def compress_payload(data):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, COMPRESSION_MEM_LEVEL,
+                                  zdict=COMPRESSION_DICTIONARY)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_payload(data, max_message_size=MAX_MESSAGE_SIZE):
+    """Raises MessageTooLargeError instead of inflating more than max_message_size bytes."""
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=COMPRESSION_DICTIONARY)
+    try:
+        payload = decompressor.decompress(data, max_message_size)
+    except zlib.error as e:
+        raise ValueError(f"Corrupt compressed message: {e}")
+    if decompressor.unconsumed_tail:
+        raise MessageTooLargeError(f"Compressed message inflates past the {max_message_size} bytes limit")
+    return payload
+
+
+def create_handshake(username, capabilities=SUPPORTED_CAPABILITIES, history_since=None):
+    """First message of a client. Legacy clients send only the username."""
+    fields = sorted(capabilities)
+    if history_since is not None:
+        fields.append(f"{HISTORY_SINCE}{history_since}")
+    return create_message(f"{username}{DELIMITER}{CAPABILITY_SEPARATOR.join(fields)}")
+
+
+def parse_handshake(data):
+    """
+    Returns the username, the capabilities the server supports out of the ones the client asked for,
+    and the unix time the client wants the history from, or None for the last messages.
+    """
+    username, _, capabilities = data.decode().partition(DELIMITER)
+    requested = set(capabilities.split(CAPABILITY_SEPARATOR)) if capabilities else set()
+    history_since = None
+    for field in requested:
+        if field.startswith(HISTORY_SINCE):
+            try:
+                history_since = float(field[len(HISTORY_SINCE):])
+            except ValueError:
+                pass
+    return username, requested & SUPPORTED_CAPABILITIES, history_since
+
+
+def create_handshake_reply(uuid, capabilities):
+    """The UUID reply is always legacy framed since the client only switches after reading it."""
+    if not capabilities:
+        return create_message(uuid)
+    return create_message(f"{uuid}{DELIMITER}{CAPABILITY_SEPARATOR.join(sorted(capabilities))}")
+
+
+def parse_handshake_reply(data):
+    uuid, _, capabilities = data.decode().partition(DELIMITER)
+    return uuid, set(capabilities.split(CAPABILITY_SEPARATOR)) if capabilities else set()
+
+
+def get_protocol_version(capabilities):
+    return PROTOCOL_V2 if CAPABILITY_V2 in capabilities else PROTOCOL_V1
+
+
+def uses_compression(capabilities):
+    """Compression is only defined for v2 framing."""
+    return CAPABILITY_ZLIB in capabilities and CAPABILITY_V2 in capabilities
@@ -0,0 +1,49 @@
+class RoomManager:
+    """Room -> members index, so a room message costs as much as the room has members. Empty rooms are dropped."""
+
+    def __init__(self):
+        self._members = {}  # room name -> dict used as an insertion-ordered set of users
+        self._user_rooms = {}  # user -> set of room names, to leave them all on quit
+
+    def join(self, room, user):
+        """Returns False if the user is already a member."""
+        members = self._members.setdefault(room, {})
+        if user in members:
+            return False
+        members[user] = None
+        self._user_rooms.setdefault(user, set()).add(room)
+        return True
+
+    def leave(self, room, user):
+        """Returns False if the user is not a member."""
+        members = self._members.get(room)
+        if members is None or user not in members:
+            return False
+        del members[user]
+        if not members:
+            del self._members[room]
+        rooms = self._user_rooms[user]
+        rooms.discard(room)
+        if not rooms:
+            del self._user_rooms[user]
+        return True
+
+    def leave_all(self, user):
+        """Removes the user from every room. Returns the rooms it was in."""
+        rooms = list(self._user_rooms.get(user, ()))
+        for room in rooms:
+            self.leave(room, user)
+        return rooms
+
+    def is_member(self, room, user):
+        return user in self._members.get(room, ())
+
+    def get_members(self, room):
+        return self._members.get(room, {}).keys()
+
+    def get_rooms(self, user):
+        return self._user_rooms.get(user, set())
+
+    def clear_room_manager(self):
+        self._members.clear()
+        self._user_rooms.clear()
@@ -1,18 +1,52 @@
+import struct
 import numpy as np
 import cv2
 from PIL import ImageGrab
+import protocol
+
+TILE_SIZE = 64
+JPEG_QUALITY = 95  # OpenCV's default
+KEYFRAME_INTERVAL = 50  # frames between full keyframes
+MAX_CHANGED_TILES_RATIO = 0.5  # above this a keyframe is cheaper than the tiles
+# Delta frame: header, then for every changed tile its position and its JPEG bytes.
+DELTA_HEADER = struct.Struct("!2sHHHH")  # magic, frame width, frame height, tile size, tile count
+TILE_HEADER = struct.Struct("!HHI")  # tile column, tile row, jpeg length
 
 
 class ScreenShareManager:
+    """
+    Frames are sent as a plain JPEG keyframe, or as a delta holding only the tiles that differ from the
+    last keyframe. Since every delta covers all the changes since its keyframe, the server may drop
+    deltas for a slow watcher and the next one still draws the right picture.
+    """
+    DELTA_MODE = True
 
-    @staticmethod
-    def watch_share_screen(frame_data):
+    # sharer state
+    _keyframe = None
+    _frames_since_keyframe = 0
+    _keyframe_requested = False
+
+    # watcher state
+    _base = None  # last keyframe received
+
+    @classmethod
+    def reset_canvas(cls):
+        cls._base = None
+
+    @classmethod
+    def watch_share_screen(cls, frame_data):
         if not frame_data or len(frame_data) < 10:  # Arbitrary minimum size for a valid frame
             print("Error: Frame data is too small or empty.")
             return
-        # Decode the binary frame data
-        frame = np.frombuffer(frame_data, dtype=np.uint8)
-        frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+        if frame_data[:len(protocol.FRAME_DELTA_MAGIC)] == protocol.FRAME_DELTA_MAGIC:
+            frame = cls._apply_delta(frame_data)
+            if frame is None:
+                return True  # joined between keyframes, wait for the next one
+        else:
+            # Decode the binary frame data
+            frame = np.frombuffer(frame_data, dtype=np.uint8)
+            frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+            cls._base = frame
 
         if frame is None or frame.size == 0:
             print("Error: Received invalid frame data.")
@@ -26,8 +60,28 @@ class ScreenShareManager:
             return False
         return True
 
-    @staticmethod
-    def capture_frame():
+    @classmethod
+    def _apply_delta(cls, frame_data):
+        _, width, height, tile_size, tile_count = DELTA_HEADER.unpack_from(frame_data)
+        if cls._base is None or cls._base.shape[:2] != (height, width):
+            return None
+        canvas = cls._base.copy()
+        offset = DELTA_HEADER.size
+        for _ in range(tile_count):
+            column, row, length = TILE_HEADER.unpack_from(frame_data, offset)
+            offset += TILE_HEADER.size
+            tile = cv2.imdecode(np.frombuffer(frame_data, np.uint8, length, offset), cv2.IMREAD_COLOR)
+            offset += length
+            y, x = row * tile_size, column * tile_size
+            canvas[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+        return canvas
+
+    @classmethod
+    def request_keyframe(cls):
+        cls._keyframe_requested = True
+
+    @classmethod
+    def capture_frame(cls, quality=JPEG_QUALITY, scale=1.0):
         # Capture the screen
         screenshot = ImageGrab.grab()
 
@@ -35,7 +89,51 @@ class ScreenShareManager:
         frame = np.array(screenshot)
 
         frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        if scale != 1.0:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        encode_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+        if cls.DELTA_MODE and not cls._needs_keyframe(frame):
+            delta = cls._encode_delta(frame, encode_params)
+            if delta is not None:
+                cls._frames_since_keyframe += 1
+                return delta
 
-        _, encoded_frame = cv2.imencode('.jpg', frame)
+        _, encoded_frame = cv2.imencode('.jpg', frame, encode_params)
         encoded_frame_bytes = encoded_frame.tobytes()
+        cls._keyframe = frame
+        cls._frames_since_keyframe = 0
+        cls._keyframe_requested = False
         return encoded_frame_bytes
+
+    @classmethod
+    def _needs_keyframe(cls, frame):
+        return (cls._keyframe is None or cls._keyframe_requested or cls._keyframe.shape != frame.shape
+                or cls._frames_since_keyframe >= KEYFRAME_INTERVAL)
+
+    @staticmethod
+    def changed_tiles(frame, base, tile_size=TILE_SIZE):
+        """(row, column) of every tile that differs between the frames."""
+        height, width, channels = frame.shape
+        # Rows of channel values, so each tile is a run of tile_size * channels columns
+        changed_values = (frame != base).reshape(height, width * channels)
+        changed = np.logical_or.reduceat(changed_values, np.arange(0, height, tile_size), axis=0)
+        changed = np.logical_or.reduceat(changed, np.arange(0, width * channels, tile_size * channels), axis=1)
+        return np.argwhere(changed)
+
+    @classmethod
+    def _encode_delta(cls, frame, encode_params):
+        """Returns None when so much changed that a keyframe should be sent instead."""
+        tiles = cls.changed_tiles(frame, cls._keyframe)
+        height, width = frame.shape[:2]
+        total_tiles = -(-height // TILE_SIZE) * -(-width // TILE_SIZE)
+        if len(tiles) > total_tiles * MAX_CHANGED_TILES_RATIO:
+            return None
+
+        parts = [DELTA_HEADER.pack(protocol.FRAME_DELTA_MAGIC, width, height, TILE_SIZE, len(tiles))]
+        for row, column in tiles:
+            y, x = row * TILE_SIZE, column * TILE_SIZE
+            _, encoded_tile = cv2.imencode('.jpg', frame[y:y + TILE_SIZE, x:x + TILE_SIZE], encode_params)
+            parts.append(TILE_HEADER.pack(column, row, len(encoded_tile)))
+            parts.append(encoded_tile.tobytes())
+        return b"".join(parts)
@@ -1,61 +1,183 @@
+import os
 import socket
-import select
+import selectors
 import logging
-from typing import List, Tuple, Optional, Any
+import time
+from operator import attrgetter
+from typing import List, Tuple, Optional, Any, Callable
 import protocol
+import cluster
+import history
+import metrics
+import serverlog
 from user import UserStatus
 from user import User
 from usermanager import UserManager
+from roommanager import RoomManager
 import message
 
-MAX_QUEUE_SIZE = 500
+SEND_BATCH_MESSAGES = 64  # buffers per sendmsg call, well below IOV_MAX
+SEND_BATCH_BYTES = 256 * 1024
+STREAM_REPORT_INTERVAL = 1.0  # seconds between STREAM_STATS messages to a sharer
+HANDSHAKE_TIMEOUT = 5.0  # seconds a new connection gets to send its username
+MAX_PENDING_HANDSHAKES = 256  # accepting stops while this many connections did not send their username
+ACCEPT_BATCH = 64  # connections accepted per readiness event of the listening socket
+MAX_HANDSHAKE_SIZE = 4096
 user_manager = UserManager()
+room_manager = RoomManager()
 
 message_types = message.Message.MESSAGE_TYPES
-available_commands = ["SEND_MESSAGE", "CHANGE_NAME", "CHANGE_STATUS", "KICK_USER", "SEND_PRIVATE_MESSAGE",
-                      "START_SHARE_SCREEN", "END_SHARE_SCREEN", "JOIN_SHARE_SCREEN", "LEAVE_SHARE_SCREEN", "QUIT"]
-open_client_sockets = []
+# Command -> handler(socket, user, content), looked up once per message instead of an if/elif chain.
+command_handlers = {
+    "SEND_MESSAGE": lambda sock, user, content: send_message(content, user),
+    "CHANGE_NAME": lambda sock, user, content: handle_change_name(content, user),
+    "CHANGE_STATUS": lambda sock, user, content: handle_status_change(user, content),
+    "KICK_USER": lambda sock, user, content: handle_kick_user(user, content),
+    "SEND_PRIVATE_MESSAGE": lambda sock, user, content: handle_private_messages(user, content),
+    "START_SHARE_SCREEN": lambda sock, user, content: handle_start_share_screen(user, content),
+    "END_SHARE_SCREEN": lambda sock, user, content: handle_end_share_screen(user),
+    "JOIN_SHARE_SCREEN": lambda sock, user, content: handle_join_share_screen(user, content),
+    "LEAVE_SHARE_SCREEN": lambda sock, user, content: handle_leave_share_screen(user),
+    "QUIT": lambda sock, user, content: handle_client_quiting(sock, user),
+    "JOIN_ROOM": lambda sock, user, content: handle_join_room(user, content),
+    "LEAVE_ROOM": lambda sock, user, content: handle_leave_room(user, content),
+    "ROOM_MESSAGE": lambda sock, user, content: handle_room_message(user, content),
+    "STATS": lambda sock, user, content: handle_stats(user),
+}
+# Wire name -> command, so a received name is looked up without being decoded.
+commands_by_wire_name = {command.encode(): command for command in command_handlers}
+message_types_by_wire_name = {message_type.encode(): message_type for message_type in message_types.values()}
+# Commands whose content starts with a room name, only members of that room may send them.
+room_commands = frozenset({"ROOM_MESSAGE", "START_SHARE_SCREEN"})
+DELIMITER_BYTE = protocol.DELIMITER.encode()
+open_client_sockets = {}  # used as an insertion-ordered set, values are None, oldest connection first
 errors_to_send = []
+# Called with the recipient every time a message is queued, so an event loop can wake that user's writer.
+on_message_queued: Optional[Callable[[User], None]] = None
+# Users whose queue overflowed under the Disconnect slow consumer policy, dropped at the end of the loop pass.
+slow_consumers = set()
+# Per-connection receive buffers, so a half-received message never blocks the loop.
+message_decoders = {}
+# Chat history replayed to new users, None until open_history is called.
+history_log: Optional[history.HistoryLog] = None
+# Client sockets are always registered for reading, and for writing only while their user has queued messages.
+selector = selectors.DefaultSelector()
+# Listening socket of the metrics endpoint, None until open_metrics_endpoint is called.
+metrics_listener = None
+# Path of the metrics endpoint when it is a unix socket, removed on shutdown.
+metrics_socket_path: Optional[str] = None
+# Metrics connections being served, oldest first like pending_handshakes.
+metrics_scrapes = {}
+# Connections that were accepted and did not send their username yet, oldest first, so the first one
+# is always the next to time out.
+pending_handshakes = {}
+# The listening socket while it is left out of the selector because MAX_PENDING_HANDSHAKES was reached.
+paused_listener = None
+
+command_seconds = metrics.histogram("chat_command_seconds", "Time to handle a client message, by command.",
+                                    ("command",))
+connections_accepted = metrics.counter("chat_connections_accepted_total", "Client connections accepted.")
+handshake_seconds = metrics.histogram("chat_handshake_seconds", "Time from accept to the UUID reply.")
+loop_iteration_seconds = metrics.histogram("chat_loop_iteration_seconds",
+                                           "Time to handle the sockets of one select() result.")
+bytes_received = metrics.counter("chat_bytes_received_total", "Payload bytes of client messages.")
+bytes_sent = metrics.counter("chat_bytes_sent_total", "Bytes sent to clients.")
+messages_dropped = metrics.counter("chat_messages_dropped_total", "Messages and frames not sent to a user.",
+                                   ("reason",))
+handshakes_failed = metrics.counter("chat_handshakes_failed_total", "Connections dropped before registering.",
+                                    ("reason",))
+handshakes_pending = metrics.gauge("chat_handshakes_pending", "Connections waiting for their username.",
+                                   collect=lambda: {(): len(pending_handshakes)})
+users_connected = metrics.gauge("chat_users", "Users connected to this server.",
+                                collect=lambda: {(): len(open_client_sockets)})
+# Only users with a backlog are reported, an idle chat of thousands of users adds nothing to a scrape.
+queued_messages = metrics.gauge("chat_user_queue_messages", "Messages waiting to be sent to a user.", ("user",),
+                                collect=lambda: collect_queues(len))
+queued_bytes = metrics.gauge("chat_user_queue_bytes", "Bytes waiting to be sent to a user.", ("user",),
+                             collect=lambda: collect_queues(attrgetter("queued_bytes")))
+
+
+class PendingHandshake:
+    """
+    A connection between accept and registration. It is accepted, then awaits its username in its own
+    decoder without blocking the loop, and is registered once the whole handshake arrived.
+    """
+
+    __slots__ = ("address", "decoder", "accepted_at", "deadline")
+
+    def __init__(self, address):
+        self.address = address
+        self.decoder = protocol.MessageDecoder(protocol.PROTOCOL_V1, MAX_HANDSHAKE_SIZE, MAX_HANDSHAKE_SIZE)
+        self.accepted_at = time.perf_counter()
+        self.deadline = time.monotonic() + HANDSHAKE_TIMEOUT
 
 
 def handle_clients(server_socket) -> None:
+    global on_message_queued
+    on_message_queued = watch_for_write
+    server_socket.setblocking(False)
+    selector.register(server_socket, selectors.EVENT_READ)
     while True:
         try:
-            rlist, wlist, _ = select.select([server_socket] + open_client_sockets, open_client_sockets, [])
-        except ValueError:
+            ready = selector.select(select_timeout())
+        except (ValueError, OSError):
             logging.error("Error in select: Cleaning up stale sockets.")
             clean_closed_sockets()
             continue
+        started = time.perf_counter()
+        rlist, wlist = [], []
+        for key, events in ready:
+            if key.fileobj.fileno() == -1:  # closed by an earlier handler in this pass
+                continue
+            if key.data is not None:  # sockets that are not clients, such as links to other nodes
+                key.data(key.fileobj, events)
+                continue
+            if events & selectors.EVENT_READ:
+                rlist.append(key.fileobj)
+            if events & selectors.EVENT_WRITE:
+                wlist.append(key.fileobj)
         if rlist:
             handle_requests(rlist, server_socket)
         if wlist:
             handle_responses_errors(wlist)
             handle_chat_responses(wlist)
+        if slow_consumers:
+            disconnect_slow_consumers()
+        if pending_handshakes:
+            expire_handshakes()
+        if metrics_scrapes:
+            expire_scrapes()
+        loop_iteration_seconds.observe(time.perf_counter() - started)
 
 
 def handle_requests(rlist, server_socket) -> None:
     for current_socket in rlist:
+        if current_socket.fileno() == -1:  # kicked by an event from another node in this pass
+            continue
         if current_socket is server_socket:
             try:
                 handle_new_connection(server_socket)
             except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
-                logging.error(f"Client crashed: {current_socket.getpeername()}")
-                handle_client_quiting(current_socket, None)
+                logging.error("Client crashed while joining.")
             except Exception as e:
                 logging.error(f"Error accepting new connection: {e}")
         else:
             try:
-                data = protocol.get_analyzed_data(current_socket)
-                if data == b"":
+                user = user_manager.get_user_by_socket(current_socket)
+                decoder = message_decoders[current_socket]
+                if not decoder.recv_from(current_socket):
                     logging.info("Connection Closed")
                     handle_client_quiting(current_socket, None)
-                elif data is None:
                     continue
-                    # print("Error while receiving")
-                else:
+                for data in decoder.messages():
                     handle_command_request(current_socket, data)
+                    if current_socket.fileno() == -1:  # quit or got kicked
+                        break
+            except protocol.MessageTooLargeError as e:
+                logging.error(f"{user.name} sent an oversized message, disconnecting: {e}")
+                handle_client_quiting(current_socket, None)
             except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
-                logging.error(f"Client crashed: {current_socket.getpeername()}")
+                logging.error(f"Client crashed: {user.address}")
                 handle_client_quiting(current_socket, None)
             except Exception as e:
                 logging.error(f"Unexpected error: {e}")
@@ -63,28 +185,151 @@ def handle_requests(rlist, server_socket) -> None:
 
 
 def handle_new_connection(server_socket) -> None:
-    connection, client_address = server_socket.accept()
-    logging.info(f"New client {client_address} joined!")
+    """
+    Accepts up to ACCEPT_BATCH connections and waits for their usernames in the loop. Past
+    MAX_PENDING_HANDSHAKES, new connections wait in the listen backlog until some handshakes end.
+    """
+    global paused_listener
+    for _ in range(ACCEPT_BATCH):
+        if len(pending_handshakes) >= MAX_PENDING_HANDSHAKES:
+            logging.warning(f"{len(pending_handshakes)} handshakes pending, pausing accepts.")
+            selector.unregister(server_socket)
+            paused_listener = server_socket
+            return
+        try:
+            connection, client_address = server_socket.accept()
+        except BlockingIOError:
+            return
+        connections_accepted.inc()
+        logging.info(f"New client {client_address} joined!")
+        connection.setblocking(False)
+        pending_handshakes[connection] = PendingHandshake(client_address)
+        selector.register(connection, selectors.EVENT_READ, handle_handshake)
+
+
+def handle_handshake(connection, events) -> None:
+    """Selector callback of a connection awaiting its username."""
+    pending = pending_handshakes[connection]
+    try:
+        if not pending.decoder.recv_from(connection):
+            drop_handshake(connection, "closed")
+            return
+        handshake = next(pending.decoder.messages(), None)
+        if handshake is None:
+            return  # the rest of the handshake comes with a later read
+        del pending_handshakes[connection]
+        complete_handshake(connection, pending, handshake)
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+        logging.error(f"Client crashed while joining: {pending.address}")
+        drop_handshake(connection, "closed")
+    except Exception as e:
+        logging.error(f"Invalid handshake from {pending.address}: {e}")
+        drop_handshake(connection, "invalid")
+    resume_accepting()
 
-    username = protocol.get_analyzed_data(connection).decode()
-    user_manager.create_user(username, connection, client_address)
-    new_user = user_manager.get_user_by_socket(connection)
 
-    if len(open_client_sockets) == 0:
+def complete_handshake(connection, pending, handshake) -> None:
+    username, capabilities, history_since = protocol.parse_handshake(handshake)
+    selector.modify(connection, selectors.EVENT_READ)  # from now on a client socket
+    new_user = register_user(username, connection, pending.address, capabilities, history_since)
+
+    # Send UUID to the client, along with the capabilities it asked for that we support.
+    # The socket buffer of a new connection is empty, so the short reply goes out whole.
+    try:
+        connection.send(protocol.create_handshake_reply(new_user.id, capabilities))
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+        logging.error(f"Client crashed while joining: {pending.address}")
+        handle_client_quiting(connection, new_user)
+        return
+    message_decoders[connection] = protocol.MessageDecoder(new_user.protocol_version)
+    handshake_seconds.observe(time.perf_counter() - pending.accepted_at)
+    logging.info(f"Assigned UUID {new_user.id} to {new_user.name} (protocol v{new_user.protocol_version})")
+
+
+def drop_handshake(connection, reason) -> None:
+    """Closes a connection that did not register. It may already be out of pending_handshakes."""
+    pending_handshakes.pop(connection, None)
+    handshakes_failed.inc(reason)
+    unregister_socket(connection)
+    connection.close()
+
+
+def select_timeout() -> Optional[float]:
+    """How long select may block before the oldest pending handshake or scrape times out, None without any."""
+    deadlines = [next(iter(pending.values())).deadline for pending in (pending_handshakes, metrics_scrapes) if pending]
+    if not deadlines:
+        return None
+    return max(0.0, min(deadlines) - time.monotonic())
+
+
+def expire_handshakes() -> None:
+    now = time.monotonic()
+    while pending_handshakes:
+        connection, pending = next(iter(pending_handshakes.items()))
+        if pending.deadline > now:
+            break
+        logging.info(f"Handshake of {pending.address} timed out")
+        drop_handshake(connection, "timeout")
+    resume_accepting()
+
+
+def resume_accepting() -> None:
+    global paused_listener
+    if paused_listener is not None and len(pending_handshakes) < MAX_PENDING_HANDSHAKES:
+        selector.register(paused_listener, selectors.EVENT_READ)
+        paused_listener = None
+
+
+def register_user(username, connection, client_address, capabilities=frozenset(), history_since=None) -> User:
+    """
+    Adds a connection that sent its username to the chat, and queues the chat history for it.
+    connection is any key with close().
+    """
+    new_user = user_manager.create_user(username, connection, client_address)
+    new_user.protocol_version = protocol.get_protocol_version(capabilities)
+    new_user.compression = protocol.uses_compression(capabilities)
+
+    if len(open_client_sockets) == 0 and not cluster.has_remote_users():
         new_user.status = UserStatus.Owner
 
-    # Update user dictionary and open sockets list
-    open_client_sockets.append(connection)
+    # Update user dictionary and open sockets set
+    open_client_sockets[connection] = None
+
+    cluster.announce_user(new_user)
+    broadcast_text_system_message(f"{new_user.name} joined the chat.", new_user)
+    if new_user.name != username:
+        send_text_system_message(f"The name {username} is taken, you joined as {new_user.name}.", [new_user])
+    replay_history(new_user, history_since)
+    return new_user
+
+
+def open_history(directory=history.HISTORY_DIR) -> None:
+    global history_log
+    history_log = history.HistoryLog(directory)
 
-    new_user_list = user_manager.get_list_of_users_without_users([new_user])
-    send_text_system_message(f"{new_user.name} joined the chat.", new_user_list)
 
-    # Send UUID to the client
-    connection.send(protocol.create_message(new_user.id))
-    logging.info(f"Assigned UUID {new_user.id} to {new_user.name}")
+def close_history() -> None:
+    global history_log
+    if history_log is not None:
+        history_log.close()
+        history_log = None
+
+
+def record_history(message_obj) -> None:
+    if history_log is not None:
+        history_log.append(message_obj.create_message().encode())
+
+
+def replay_history(user, since=None) -> None:
+    if history_log is None:
+        return
+    for payload in history_log.replay(since=since):
+        queue_message(user, message.RelayedMessage(payload, message_types["Text"]))
 
 
 def handle_command_request(current_socket, data) -> None:
+    started = time.perf_counter()
+    bytes_received.inc(amount=len(data))
     try:
         uuid, message_type, command, content, user = analyze_command(current_socket, data)
     except Exception as e:
@@ -94,119 +339,159 @@ def handle_command_request(current_socket, data) -> None:
         return
 
     if message_type == message_types["Binary"]:
-        send_frame(content, user.watchers)
-
+        send_frame(content, user.watchers, user)
+        command = "FRAME"
     elif message_type == message_types["Text"]:
-        if command == "SEND_MESSAGE":  # Send message
-            send_message(content, user)
-        elif command == "CHANGE_NAME":  # Update username
-            handle_change_name(content, user)
-        elif command == "QUIT":  # Quit
-            handle_client_quiting(current_socket, user)
-        elif command == "CHANGE_STATUS":
-            handle_status_change(user, content)
-        elif command == "KICK_USER":
-            handle_kick_user(user, content)
-        elif command == "SEND_PRIVATE_MESSAGE":
-            handle_private_messages(user, content)
-        elif command == "START_SHARE_SCREEN":
-            handle_start_share_screen(user)
-        elif command == "JOIN_SHARE_SCREEN":
-            handle_join_share_screen(user, content)
-        elif command == "LEAVE_SHARE_SCREEN":
-            handle_leave_share_screen(user)
-        elif command == "END_SHARE_SCREEN":
-            handle_end_share_screen(user)
-
-
-def analyze_command(current_socket, data) -> None | tuple[str, str, Optional[str], bytes, Optional[User]]:
-    # Define the delimiter as bytes
-    delimiter = protocol.DELIMITER.encode()
-
-    # Find the first three delimiters to separate the header
-
-    uuid_end = data.find(delimiter)
-    type_end = data.find(delimiter, uuid_end + 1)
-
-    # Extract uuid, message_type, and command
-    uuid = data[:uuid_end].decode()
-    message_type = data[uuid_end + 1:type_end].decode()
-    content = data[type_end + 1:]
+        command_handlers[command](current_socket, user, content)
+    command_seconds.observe(time.perf_counter() - started, command or "INVALID")
+
+
+def analyze_command(current_socket, data) -> None | tuple[str, str, Optional[str], str | bytes | memoryview, Optional[User]]:
+    """
+    Splits "uuid|type|command|content" by offsets into data. Only the content of a text command is decoded,
+    the payload of a frame is returned as a memoryview and never copied. The short header fields are
+    compared in place or sliced, which is cheaper than hashing a memoryview of them.
+    """
+    uuid_end = data.find(DELIMITER_BYTE)
+    type_end = data.find(DELIMITER_BYTE, uuid_end + 1)
 
     # Validate user
     user = user_manager.get_user_by_socket(current_socket)
-    if not user or user.id != uuid:
+    if not user or uuid_end != len(user.id) or not data.startswith(user.id.encode()):
         send_text_system_message("Error: Invalid UUID", [user])
         return "", "", None, b"", None
 
     # Validate message type
-    if message_type not in message_types.values():
+    message_type = message_types_by_wire_name.get(data[uuid_end + 1:type_end])
+    if message_type is None:
         send_text_system_message("Error: Invalid type", [user])
         return "", "", None, b"", None
     if message_type == message_types["Binary"]:
-        return uuid, message_type, None, content, user
+        return user.id, message_type, None, memoryview(data)[type_end + 1:], user
 
-    command_end = data.find(delimiter, type_end + 1)
-    command = data[type_end + 1:command_end].decode()
-    # Extract content
+    command_end = data.find(DELIMITER_BYTE, type_end + 1)
+    command = commands_by_wire_name.get(data[type_end + 1:command_end])
     content = data[command_end + 1:]  # Everything after the last delimiter
     if message_type == message_types["Text"]:
-        # Decode content if it's text
-        content = content.decode()
-        if command not in available_commands:
+        if command is None:
             send_text_system_message("Error: Command does not exist", [user])
             return "", "", None, b"", None
+        content = content.decode()
+        if command in room_commands:
+            room = content.partition(protocol.DELIMITER)[0]
+            if room and not room_manager.is_member(room, user):
+                send_text_system_message("Error: Not a member of room.", [user])
+                if command == "START_SHARE_SCREEN":
+                    send_system_message(user, "DENIED_START")
+                return "", "", None, b"", None
     # Return the parsed components
-    return uuid, message_type, command, content, user
+    return user.id, message_type, command, content, user
 
 
 def send_message(content, sender_user) -> None:
     message_obj = message.ChatMessage(content, message_types["Text"], sender_user.name)
     for user in user_manager.get_users():
         if sender_user != user:
-            if len(user.message_queue) < MAX_QUEUE_SIZE:
-                user.message_queue.append(message_obj)
-            else:
-                logging.info(f"Message queue for {user.name} is full. Dropping message.")
+            queue_message(user, message_obj)
+    record_history(message_obj)
+    cluster.broadcast(message_obj, history=True)
+
+
+def queue_message(user, message_obj) -> bool:
+    if type(user) is cluster.RemoteUser:
+        cluster.deliver(user, message_obj)
+        return True
+    if not user.message_queue.push(message_obj.get_wire_bytes(user.protocol_version, user.compression),
+                                   message_obj.message_type):
+        if not user.message_queue.overflowed:
+            messages_dropped.inc("queue_full")
+            logging.info(f"Message queue for {user.name} is full. Dropping message.")
+            return False
+        messages_dropped.inc("slow_consumer")
+        if user not in slow_consumers:
+            logging.info(f"Message queue for {user.name} is full. Disconnecting slow user.")
+            slow_consumers.add(user)
+    if on_message_queued is not None:
+        on_message_queued(user)
+    return not user.message_queue.overflowed
+
+
+def disconnect_slow_consumers() -> None:
+    while slow_consumers:
+        user = slow_consumers.pop()
+        sock = user_manager.get_socket_by_user(user)
+        if sock is not None:
+            handle_client_quiting(sock, user)
+
+
+def watch_for_write(user) -> None:
+    sock = user_manager.get_socket_by_user(user)
+    if sock is None or sock.fileno() == -1:
+        return
+    key = selector.get_key(sock)
+    if not key.events & selectors.EVENT_WRITE:
+        selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+
+def stop_watching_for_write(sock) -> None:
+    if sock.fileno() != -1:
+        selector.modify(sock, selectors.EVENT_READ)
+
+
+def unregister_socket(sock) -> None:
+    try:
+        selector.unregister(sock)
+    except (KeyError, ValueError):
+        pass  # never registered, e.g. an asyncio writer
 
 
 def send_system_message(user, content) -> None:
     message_obj = message.SystemMessage(content, message_types["System"])
-    if len(user.message_queue) < MAX_QUEUE_SIZE:
-        user.message_queue.append(message_obj)
-    else:
-        logging.info(f"Message queue for {user.name} is full. Dropping message.")
+    queue_message(user, message_obj)
 
 
 def handle_change_name(content, user) -> None:
-    logging.info(f"User {user.name} changed name to {content}")
-    user.name = content
+    old_name = user.name
+    if not user_manager.rename_user(user, content):
+        send_text_system_message("Error: Name already taken.", [user])
+        return
+    cluster.publish("user_renamed", user_id=user.id, name=user.name)
+    logging.info(f"User {old_name} changed name to {content}")
 
 
 def handle_client_quiting(current_socket, user) -> None:
     if user is None:
         user = user_manager.get_user_by_socket(current_socket)
-    handle_leave_share_screen(user)
-    list_of_users = user_manager.get_list_of_users_without_users([user])
-    send_text_system_message(f"{user.name} left the chat.", list_of_users)
+    if user.watching is not None:
+        handle_leave_share_screen(user)
+    if user.is_sharing_screen:
+        handle_end_share_screen(user)
+    broadcast_text_system_message(f"{user.name} left the chat.", user)
     remove_user(current_socket)
 
 
 def send_text_system_message(content, list_of_users) -> None:
     message_obj = message.TextSystemMessage(content, message_types["Text"])
     for user in list_of_users:
-        if len(user.message_queue) < MAX_QUEUE_SIZE:
-            user.message_queue.append(message_obj)
-        else:
-            logging.info(f"Message queue for {user.name} is full. Dropping message.")
+        queue_message(user, message_obj)
+
+
+def broadcast_text_system_message(content, *excluded_users) -> None:
+    """Sends to every user in the chat but the excluded ones, including the users of other nodes."""
+    message_obj = message.TextSystemMessage(content, message_types["Text"])
+    for user in user_manager.iter_users_except(*excluded_users):
+        queue_message(user, message_obj)
+    cluster.broadcast(message_obj)
+
+
+def find_user_by_name(username) -> Optional[User | cluster.RemoteUser]:
+    """Local users first, then the users of other nodes."""
+    return user_manager.get_user_by_name(username) or cluster.get_remote_user_by_name(username)
 
 
 def send_private_message(content, sender_user, recipient_user) -> None:
     message_obj = message.PrivateMessage(content, message_types["Text"], sender_user.name)
-    if len(recipient_user.message_queue) < MAX_QUEUE_SIZE:
-        recipient_user.message_queue.append(message_obj)
-    else:
-        logging.info(f"Message queue for {recipient_user.name} is full. Dropping message.")
+    queue_message(recipient_user, message_obj)
 
 
 def handle_private_messages(sender, content) -> None:
@@ -216,11 +501,10 @@ def handle_private_messages(sender, content) -> None:
         return
 
     recipient_name = data_parts[0]
-    recipient = user_manager.get_user_by_name(recipient_name)
+    recipient = find_user_by_name(recipient_name)
     if not recipient:
         send_text_system_message("Error: Recipient not found.", [sender])
         return
-    recipient = recipient[0]
 
     content = f"{protocol.DELIMITER}".join(data_parts[1:])
     send_private_message(content, sender, recipient)
@@ -238,17 +522,24 @@ def handle_status_change(sender, content) -> None:
     status_to_change_to = int(status_to_change_to)
 
     recipient_name = content[1:]
-    recipient = user_manager.get_user_by_name(recipient_name)
+    recipient = find_user_by_name(recipient_name)
     if not recipient:
         send_text_system_message("Error: Recipient not found.", [sender])
         return
-    recipient = recipient[0]
 
     if recipient.status == UserStatus.Owner:
         send_text_system_message("Error: Cannot change status to owner.", [sender])
         return
-    recipient.status = UserStatus(status_to_change_to)
-    send_text_system_message(f"{recipient.name} status changed to {recipient.status}.", user_manager.get_users())
+    if type(recipient) is cluster.RemoteUser:
+        cluster.send_to(recipient.node_id, "set_status", user_id=recipient.id, status=status_to_change_to)
+        return
+    set_user_status(recipient, UserStatus(status_to_change_to))
+
+
+def set_user_status(user, status) -> None:
+    user.status = status
+    cluster.publish("status_changed", user_id=user.id, status=status.value)
+    broadcast_text_system_message(f"{user.name} status changed to {user.status}.")
 
 
 def handle_kick_user(sender, recipient_name) -> None:
@@ -256,22 +547,27 @@ def handle_kick_user(sender, recipient_name) -> None:
         send_text_system_message("Error: Not enough permissions.", [sender])
         return
 
-    recipient = user_manager.get_user_by_name(recipient_name)
+    recipient = find_user_by_name(recipient_name)
     if not recipient:
         send_text_system_message("Error: Recipient not found.", [sender])
         return
-    recipient = recipient[0]
 
     if recipient.status == UserStatus.Owner:
         send_text_system_message("Error: Cannot kick owner.", [sender])
         return
+    if type(recipient) is cluster.RemoteUser:
+        cluster.send_to(recipient.node_id, "kick", user_id=recipient.id, kicked_by=sender.name)
+        return
+    kick_user(recipient, sender.name)
+
 
-    recipient_sock = user_manager.get_socket_by_user(recipient)
-    handle_client_quiting(recipient_sock, recipient)
-    send_text_system_message(f"{recipient_name} was kicked by {sender.name}", user_manager.get_users())
+def kick_user(user, kicked_by) -> None:
+    handle_client_quiting(user_manager.get_socket_by_user(user), user)
+    broadcast_text_system_message(f"{user.name} was kicked by {kicked_by}")
 
 
-def handle_start_share_screen(user) -> None:
+def handle_start_share_screen(user, room="") -> None:
+    """With a room, only its members can watch."""
     if type(user) is not User:
         logging.error("Was not given user")
         send_system_message(user, "DENIED_START")
@@ -282,6 +578,8 @@ def handle_start_share_screen(user) -> None:
         send_text_system_message("Error: Already Sharing Screen.", [user])
         send_system_message(user, "DENIED_START")
         return
+    user.share_room = room or None
+    cluster.publish("share_started", user_id=user.id, share_room=user.share_room)
     send_system_message(user, "CONFIRM_START")
     logging.info(f"{user.name} Started ShareScreen")
 
@@ -294,25 +592,32 @@ def handle_end_share_screen(user) -> None:
         send_text_system_message(f"Share-screen is not activated.", user.watchers)
         return
     send_text_system_message(f"{user.name} ended stream.", user.watchers)
-    for watcher in user.watchers:
+    for watcher in list(user.watchers):  # leaving removes the watcher from the set
         handle_leave_share_screen(watcher)
     user.is_sharing_screen = False
+    user.share_room = None
+    cluster.remote_watcher_nodes.pop(user.id, None)
+    cluster.publish("share_ended", user_id=user.id)
 
 
 def handle_join_share_screen(user, content) -> None:
     screen_sharer_name = content
-    screen_sharer = user_manager.get_user_by_name(screen_sharer_name)
+    screen_sharer = find_user_by_name(screen_sharer_name)
     if not screen_sharer:
         send_text_system_message("Error: Screen-sharer not found.", [user])
         send_system_message(user, "DENIED_JOIN")
         return
-    screen_sharer = screen_sharer[0]
 
     if not screen_sharer.is_sharing_screen:
         send_text_system_message("Error: User is not Sharing screen.", [user])
         send_system_message(user, "DENIED_JOIN")
         return
 
+    if screen_sharer.share_room is not None and not room_manager.is_member(screen_sharer.share_room, user):
+        send_text_system_message(f"Error: Screen-share is for room {screen_sharer.share_room} members.", [user])
+        send_system_message(user, "DENIED_JOIN")
+        return
+
     if user.watching is not None:
         send_text_system_message("Error: Already watching stream.", [user])
         send_system_message(user, "DENIED_JOIN")
@@ -324,6 +629,7 @@ def handle_join_share_screen(user, content) -> None:
         return
 
     send_system_message(user, "CONFIRM_JOIN")
+    send_system_message(screen_sharer, "REQUEST_KEYFRAME")  # the new watcher has nothing to apply deltas to
     send_text_system_message(f"{user.name} joined stream.", [user, screen_sharer])
     screen_sharer.add_user_to_watchers_list(user)
     user.watching = screen_sharer
@@ -339,16 +645,92 @@ def handle_leave_share_screen(user) -> None:
     send_system_message(user, "DISCONNECT")
     send_text_system_message(f"{user.name} left stream.", [user, user.watching])
     logging.info(f"{user.name} Joined {user.watching.name} Stream")
+    logging.info(f"{user.name} frames delivered: {user.message_queue.frames_delivered}, "
+                 f"superseded: {user.message_queue.frames_superseded}")
     user.watching = None
 
 
-def send_frame(content, list_of_users) -> None:
+def handle_join_room(user, room) -> None:
+    if not room or protocol.DELIMITER in room:
+        send_text_system_message("Error: Invalid room name.", [user])
+        return
+    if not room_manager.join(room, user):
+        send_text_system_message("Error: Already in room.", [user])
+        return
+    send_room_text_system_message(room, f"{user.name} joined room {room}.")
+
+
+def handle_leave_room(user, room) -> None:
+    if not room_manager.is_member(room, user):
+        send_text_system_message("Error: Not a member of room.", [user])
+        return
+    leave_room(user, room)
+
+
+def leave_room(user, room) -> None:
+    """A stream limited to the room ends for the user, whether sharing or watching it."""
+    if user.is_sharing_screen and user.share_room == room:
+        handle_end_share_screen(user)
+    if user.watching is not None and user.watching.share_room == room:
+        handle_leave_share_screen(user)
+    send_room_text_system_message(room, f"{user.name} left room {room}.")
+    room_manager.leave(room, user)
+
+
+def handle_room_message(sender, content) -> None:
+    room, _, text = content.partition(protocol.DELIMITER)
+    if not room or not text:
+        send_text_system_message("Error: params length.", [sender])
+        return
+    message_obj = message.RoomMessage(text, message_types["Text"], sender.name, room)
+    for user in room_manager.get_members(room):
+        if user is not sender:
+            queue_message(user, message_obj)
+    cluster.broadcast_to_room(room, message_obj)
+
+
+def send_room_text_system_message(room, content) -> None:
+    message_obj = message.TextSystemMessage(content, message_types["Text"])
+    for user in room_manager.get_members(room):
+        queue_message(user, message_obj)
+    cluster.broadcast_to_room(room, message_obj)
+
+
+def handle_stats(user) -> None:
+    """Sends the metrics of this server to an administrator, in the same text format as the metrics endpoint."""
+    if user.status != UserStatus.Administrator and user.status != UserStatus.Owner:
+        send_text_system_message("Error: Not enough permissions.", [user])
+        return
+    send_text_system_message(metrics.render(), [user])
+
+
+def send_frame(content, list_of_users, sharer=None) -> None:
     message_obj = message.Frame(content, message_types["Binary"])
+    frames_dropped = 0
     for user in list_of_users:
-        if len(user.message_queue) < MAX_QUEUE_SIZE:
-            user.message_queue.append(message_obj)
-        else:
-            logging.info(f"Message queue for {user.name} is full. Dropping message.")
+        # A watcher only needs the newest frame, one that was not sent yet is replaced
+        if user.message_queue.set_frame(message_obj.get_wire_bytes(user.protocol_version), message_obj.is_keyframe):
+            frames_dropped += 1
+        if on_message_queued is not None:
+            on_message_queued(user)
+    if frames_dropped:
+        messages_dropped.inc("frame_superseded", amount=frames_dropped)
+    if sharer is not None:
+        cluster.relay_frame(sharer, message_obj)
+        report_stream_stats(sharer, list_of_users, frames_dropped)
+
+
+def report_stream_stats(sharer, watchers, frames_dropped) -> None:
+    """Tells the sharer how far behind its slowest watcher is, so it can lower its bitrate."""
+    sharer.frames_dropped_since_report += frames_dropped
+    now = time.monotonic()
+    if now - sharer.stream_report_time < STREAM_REPORT_INTERVAL:
+        return
+    queued_bytes = max((watcher.message_queue.queued_bytes for watcher in watchers), default=0)
+    send_system_message(sharer, f"STREAM_STATS{protocol.DELIMITER}{queued_bytes}"
+                                f"{protocol.DELIMITER}{sharer.frames_dropped_since_report}")
+    sharer.stream_report_time = now
+    sharer.frames_dropped_since_report = 0
 
 
 def handle_responses_errors(wlist) -> None:
@@ -366,68 +748,225 @@ def handle_responses_errors(wlist) -> None:
 def handle_chat_responses(wlist) -> None:
     for sock in wlist:
         user = user_manager.get_user_by_socket(sock)
-        if not user or len(user.message_queue) == 0:
+        if not user:
             continue
 
-        while len(user.message_queue) > 0:
-            message_obj = user.message_queue.pop(0)
-            try:
-                sock.send(protocol.create_message(message_obj.create_message()))
-                # logging.info(f"Sent message to {user.name}: {message_obj.content}")
-            except BlockingIOError:
-                user.message_queue.insert(0, message_obj)
-                break
-            except ConnectionResetError:
-                logging.error(f"Connection reset during send to {user.name}")
-                handle_client_quiting(sock, user)
-                break
+        queue = user.message_queue
+        try:
+            bytes_sent.inc(amount=queue.flush(sock, SEND_BATCH_MESSAGES, SEND_BATCH_BYTES))
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+            logging.error(f"Connection reset during send to {user.name}")
+            handle_client_quiting(sock, user)
+            continue
+        if len(queue) == 0:
+            stop_watching_for_write(sock)
 
 
 def remove_user(sock) -> None:
     user = user_manager.remove_user(sock)
     if user:
-        open_client_sockets.remove(sock)
+        room_manager.leave_all(user)
+        del open_client_sockets[sock]
+        unregister_socket(sock)
+        message_decoders.pop(sock, None)
         sock.close()
         logging.info(f"User {user.name} disconnected.")
+        cluster.publish("user_left", user_id=user.id)
         if open_client_sockets and user.status == UserStatus.Owner:
-            new_owner = user_manager.get_user_by_socket(open_client_sockets[0])
+            new_owner = user_manager.get_user_by_socket(next(iter(open_client_sockets)))
             new_owner.status = UserStatus.Owner
-            send_text_system_message(f"Owner {user.name} has left and {new_owner.name} has been promoted to Owner.",
-                                     user_manager.get_users())
+            cluster.publish("status_changed", user_id=new_owner.id, status=new_owner.status.value)
+            broadcast_text_system_message(f"Owner {user.name} has left and {new_owner.name} has been promoted to Owner.")
+
+
+def handle_cluster_event(header, body) -> None:
+    """Applies an event from another node to the users of this one."""
+    event = header["event"]
+    if event == "hello":
+        for user in user_manager.get_users():
+            cluster.announce_user(user, header["node"])
+    elif event == "broadcast":
+        message_obj = message.RelayedMessage(body, header["message_type"])
+        for user in user_manager.get_users():
+            queue_message(user, message_obj)
+        if header.get("history") and history_log is not None:
+            history_log.append(body)
+    elif event == "room_broadcast":
+        message_obj = message.RelayedMessage(body, header["message_type"])
+        for user in room_manager.get_members(header["room"]):
+            queue_message(user, message_obj)
+    elif event == "deliver":
+        user = user_manager.get_user_by_id(header["user_id"])
+        if user is not None:
+            queue_message(user, message.RelayedMessage(body, header["message_type"]))
+    elif event == "frame":
+        sharer = cluster.get_remote_user(header["sharer_id"])
+        if sharer is not None and sharer.watchers:
+            send_frame(body, sharer.watchers)
+    elif event == "kick":
+        user = user_manager.get_user_by_id(header["user_id"])
+        if user is not None:
+            kick_user(user, header["kicked_by"])
+    elif event == "set_status":
+        user = user_manager.get_user_by_id(header["user_id"])
+        if user is not None and user.status != UserStatus.Owner:
+            set_user_status(user, UserStatus(header["status"]))
+    elif event == "share_ended":
+        sharer = cluster.get_remote_user(header["user_id"])
+        if sharer is not None:
+            end_remote_share(sharer)
+    elif event == "user_left":
+        remote_user = cluster.remove_remote_user(header["user_id"])
+        if remote_user is not None:
+            end_remote_share(remote_user)
+    elif event == "node_lost":
+        for remote_user in cluster.remove_node_users(header["node"]):
+            end_remote_share(remote_user)
+
+
+def end_remote_share(sharer) -> None:
+    """Makes the local watchers of a user on another node leave, when it stops sharing or is gone."""
+    sharer.is_sharing_screen = False
+    sharer.share_room = None
+    if sharer.watchers:
+        send_text_system_message(f"{sharer.name} ended stream.", sharer.watchers)
+    for watcher in list(sharer.watchers):
+        handle_leave_share_screen(watcher)
+
+
+def collect_queues(measure):
+    return {(user.name,): measure(user.message_queue) for user in user_manager.get_users() if len(user.message_queue)}
+
+
+def open_metrics_endpoint(address=(metrics.METRICS_HOST, metrics.METRICS_PORT)) -> bool:
+    """Serves the metrics over HTTP in Prometheus text format, on a (host, port) or a unix socket path."""
+    global metrics_listener, metrics_socket_path
+    try:
+        metrics_listener = metrics.create_listener(address)
+    except OSError as e:
+        logging.error(f"Cannot open the metrics endpoint on {address}: {e}")
+        return False
+    if isinstance(address, str):
+        metrics_socket_path = address
+    selector.register(metrics_listener, selectors.EVENT_READ, handle_metrics_request)
+    logging.info(f"Metrics endpoint listening on {address}")
+    return True
+
+
+def handle_metrics_request(listener, events) -> None:
+    """Selector callback of the metrics listener."""
+    for _ in range(ACCEPT_BATCH):
+        try:
+            connection, _ = listener.accept()
+        except BlockingIOError:
+            return
+        connection.setblocking(False)
+        metrics_scrapes[connection] = metrics.Scrape()
+        selector.register(connection, selectors.EVENT_READ, handle_scrape)
+
+
+def handle_scrape(connection, events) -> None:
+    """Selector callback of a metrics connection: reads its request, then sends the response."""
+    scrape = metrics_scrapes[connection]
+    try:
+        if scrape.response is None:
+            if not scrape.receive(connection):
+                close_scrape(connection)
+            elif scrape.response is not None:
+                selector.modify(connection, selectors.EVENT_WRITE, handle_scrape)
+        elif scrape.send(connection):
+            close_scrape(connection)
+    except BlockingIOError:
+        pass
+    except OSError:
+        close_scrape(connection)  # the scraper went away, it will try again
+
+
+def close_scrape(connection) -> None:
+    metrics_scrapes.pop(connection, None)
+    unregister_socket(connection)
+    connection.close()
+
+
+def expire_scrapes() -> None:
+    now = time.monotonic()
+    while metrics_scrapes:
+        connection, scrape = next(iter(metrics_scrapes.items()))
+        if scrape.deadline > now:
+            break
+        close_scrape(connection)
+
+
+def close_metrics_endpoint() -> None:
+    global metrics_listener, metrics_socket_path
+    for connection in list(metrics_scrapes):
+        close_scrape(connection)
+    if metrics_listener is None:
+        return
+    unregister_socket(metrics_listener)
+    if metrics_socket_path is not None:
+        try:
+            os.unlink(metrics_socket_path)
+        except FileNotFoundError:
+            pass
+        metrics_socket_path = None
+    metrics_listener.close()
+    metrics_listener = None
 
 
 def clean_closed_sockets() -> None:
-    for sock in open_client_sockets:
+    for sock in list(open_client_sockets):
         if sock.fileno() == -1:
-            open_client_sockets.remove(sock)
+            del open_client_sockets[sock]
+            unregister_socket(sock)
+            message_decoders.pop(sock, None)
             user_manager.remove_user(sock)
 
 
-def main() -> None:
-    """
-    Start the server and handle client connections.
-    """
-    print("Setting up server...")
+def create_server_socket(reuse_port=False, port=None) -> socket.socket:
+    """With reuse_port several processes listen on the same port and the kernel spreads connections between them."""
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-    server_socket.bind((protocol.SERVER_IP, protocol.SERVER_PORT))
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((protocol.SERVER_IP, port or protocol.SERVER_PORT))
     server_socket.listen()
-    print("Listening for clients...")
+    return server_socket
 
-    # setup log file and configuration
-    logging.basicConfig(filename='log.log', level=logging.INFO, filemode='w',
-                        format=f'%(asctime)s -%(levelname)s - %(message)s')
 
+def serve(server_socket) -> None:
     try:
         handle_clients(server_socket)
     except KeyboardInterrupt:
         logging.info("Shutting down server gracefully...")
     finally:
         user_manager.clear_user_manager()
+        room_manager.clear_room_manager()
+        close_history()
+        close_metrics_endpoint()
         for sock in open_client_sockets:
             sock.close()
+        for sock in pending_handshakes:
+            sock.close()
+        pending_handshakes.clear()
+        selector.close()
         server_socket.close()
+        serverlog.stop()
+
+
+def main() -> None:
+    """
+    Start the server and handle client connections.
+    """
+    print("Setting up server...")
+    server_socket = create_server_socket()
+    print("Listening for clients...")
+
+    # setup log file and configuration
+    serverlog.setup('log.log')
+    open_history()
+    open_metrics_endpoint()
 
+    serve(server_socket)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,118 @@
+import copy
+import json
+import logging
+import queue
+import time
+from typing import Optional
+from logging.handlers import QueueHandler, QueueListener
+import metrics
+
+LOG_QUEUE_SIZE = 10_000  # records waiting for the writer thread, newer ones are dropped past it
+RATE_LIMIT_WINDOW = 1.0  # seconds
+RATE_LIMIT_BURST = 20  # records per call site and window, the rest are counted and dropped
+
+records_dropped = metrics.counter("chat_log_records_dropped_total", "Log records that were not written.",
+                                  ("reason",))
+# Writer thread of the log file, None until setup is called.
+listener: Optional[QueueListener] = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets RATE_LIMIT_BURST records per window through from every call site, so a warning logged for
+    each event of a busy loop cannot flood the log. The next record of a call site that was cut says
+    how many were dropped.
+    """
+
+    def __init__(self, window=RATE_LIMIT_WINDOW, burst=RATE_LIMIT_BURST):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self._sites = {}  # (path, line) -> [window start, records let through, records dropped]
+
+    def filter(self, record):
+        now = time.monotonic()
+        site = self._sites.get((record.pathname, record.lineno))
+        if site is None:
+            site = self._sites[(record.pathname, record.lineno)] = [now, 0, 0]
+        elif now - site[0] >= self.window:
+            site[0] = now
+            site[1] = 0
+        if site[1] >= self.burst:
+            site[2] += 1
+            records_dropped.inc("rate_limited")
+            return False
+        site[1] += 1
+        if site[2]:
+            record.suppressed = site[2]
+            site[2] = 0
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Drops a record when the queue is full, instead of making the network thread wait for the disk."""
+
+    def prepare(self, record):
+        """Renders the message and the traceback now, the objects they refer to may change before they are written."""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            records_dropped.inc("queue_full")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.name != "root":
+            entry["logger"] = record.name
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed  # records of this call site dropped since the last one written
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+def setup(filename, level=logging.INFO) -> None:
+    """
+    Sends the records of the process to a writer thread that appends them to filename as JSON lines.
+    Logging calls only filter the record and put it in a queue.
+    """
+    global listener
+    file_handler = logging.FileHandler(filename, mode='w')
+    file_handler.setFormatter(JsonFormatter())
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RateLimitFilter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener = QueueListener(queue_handler.queue, file_handler)
+    listener.start()
+
+
+def stop() -> None:
+    """Writes the records still queued and closes the log file."""
+    global listener
+    if listener is None:
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    listener = None
@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+import selectors
+import socket
+import cluster
+import history
+import server
+import serverlog
+
+SHARD_COUNT = os.cpu_count() or 1
+
+
+def create_bus_sockets(shard_count):
+    """One socketpair per pair of shards. Returns, for every shard, its end of each pair by peer shard."""
+    ends = [{} for _ in range(shard_count)]
+    for shard in range(shard_count):
+        for peer in range(shard + 1, shard_count):
+            ends[shard][peer], ends[peer][shard] = socket.socketpair()
+    return ends
+
+
+def shard_name(shard):
+    return f"shard{shard}"
+
+
+def run_shard(shard, ends) -> None:
+    # Close the ends of the other shards, so a shard that dies is seen as a closed connection.
+    for other, other_ends in enumerate(ends):
+        if other != shard:
+            for sock in other_ends.values():
+                sock.close()
+
+    serverlog.setup(f'log_{shard_name(shard)}.log')
+    # The epoll object made when server was imported is shared by every forked process
+    server.selector = selectors.DefaultSelector()
+    server_socket = server.create_server_socket(reuse_port=True)
+    server.open_history(f"{history.HISTORY_DIR}_{shard_name(shard)}")
+    server.open_metrics_endpoint(f"metrics_{shard_name(shard)}.sock")
+    bus = cluster.ShardBus({shard_name(peer): sock for peer, sock in ends[shard].items()})
+    cluster.start(bus, shard_name(shard), server.selector, server.handle_cluster_event)
+    server.serve(server_socket)
+
+
+def main(shard_count=SHARD_COUNT) -> None:
+    """
+    Runs one server process per shard, all accepting on the same port. Users of different shards
+    see each other through the bus, so they can chat and watch each other's screen.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("SO_REUSEPORT is not available on this platform, run server.py instead.")
+        return
+    print(f"Starting {shard_count} shards...")
+    context = multiprocessing.get_context("fork")
+    ends = create_bus_sockets(shard_count)
+    workers = [context.Process(target=run_shard, args=(shard, ends), name=shard_name(shard))
+               for shard in range(shard_count)]
+    for worker in workers:
+        worker.start()
+    for shard_ends in ends:
+        for sock in shard_ends.values():
+            sock.close()
+    print("Listening for clients...")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,14 @@
+import socket
 import uuid
+from collections import deque
+from itertools import islice
 from enum import Enum
+import protocol
+from message import Message
+
+MAX_QUEUE_SIZE = 500  # messages
+MAX_QUEUE_BYTES = 8 * 1024 * 1024
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")  # not available on Windows
 
 
 class UserStatus(Enum):
@@ -8,17 +17,207 @@ class UserStatus(Enum):
     Owner = 3
 
 
+class SlowConsumerPolicy(Enum):
+    DropOldest = 1
+    DropNewest = 2
+    Disconnect = 3
+
+
+SLOW_CONSUMER_POLICY = SlowConsumerPolicy.DropNewest
+
+SYSTEM = Message.MESSAGE_TYPES["System"]
+TEXT = Message.MESSAGE_TYPES["Text"]
+BINARY = Message.MESSAGE_TYPES["Binary"]
+# Outbound lanes from the highest priority, and how many messages each one sends per round.
+LANE_WEIGHTS = {SYSTEM: 4, TEXT: 2, BINARY: 1}
+
+
+class OutboundQueue:
+    """
+    Framed messages waiting to be sent to one user, capped by message count and by bytes.
+    Messages wait in a lane per message type and are moved into the send order by weighted priority,
+    so system and text messages overtake screen-share frames. Binary is a single frame slot where a
+    newer frame replaces one that did not start sending. Messages already in the send order keep
+    their place, and the first one may be partly sent already.
+    """
+
+    __slots__ = ("max_messages", "max_bytes", "policy", "queued_bytes", "overflowed", "_lanes", "_frame",
+                 "_frame_is_keyframe", "_send_order", "_scheduled_bytes", "_sent_offset", "frames_delivered",
+                 "frames_superseded")
+
+    def __init__(self, max_messages=MAX_QUEUE_SIZE, max_bytes=MAX_QUEUE_BYTES, policy=SLOW_CONSUMER_POLICY):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.queued_bytes = 0
+        self.overflowed = False  # set when the Disconnect policy was triggered
+        self._lanes = {}  # message type -> deque, created on the first message of that type
+        self._frame = None  # newest frame that did not start sending yet
+        self._frame_is_keyframe = False
+        self._send_order = None  # deque of (wire bytes, message type) in the order they go on the socket
+        self._scheduled_bytes = 0
+        self._sent_offset = 0  # bytes of the first message in the send order already sent
+        self.frames_delivered = 0
+        self.frames_superseded = 0
+
+    def __len__(self):
+        return self._message_count() + (self._frame is not None)
+
+    def _message_count(self):
+        return len(self._send_order or ()) + sum(map(len, self._lanes.values()))
+
+    def _is_full(self, size):
+        if self._message_count() == 0:
+            return False  # a single message is always accepted, even if bigger than the budget
+        return self._message_count() >= self.max_messages or self.queued_bytes + size > self.max_bytes
+
+    def push(self, wire_bytes, message_type=TEXT):
+        """Returns False if the message was not queued because of the slow consumer policy."""
+        size = len(wire_bytes)
+        if self._is_full(size):
+            if self.policy == SlowConsumerPolicy.DropNewest:
+                return False
+            if self.policy == SlowConsumerPolicy.Disconnect:
+                self.overflowed = True
+                return False
+            # DropOldest, starting from the least important lane. The send order is kept as it is.
+            for lane_type in reversed(LANE_WEIGHTS):
+                lane = self._lanes.get(lane_type)
+                while lane and self._is_full(size):
+                    self.queued_bytes -= len(lane.popleft())
+            if self._is_full(size):
+                return False
+        lane = self._lanes.get(message_type)
+        if lane is None:
+            lane = self._lanes[message_type] = deque()
+        lane.append(wire_bytes)
+        self.queued_bytes += size
+        return True
+
+    def set_frame(self, wire_bytes, is_keyframe=True):
+        """
+        Queues a frame, replacing the previous one if it did not start sending yet.
+        A delta never replaces a waiting keyframe, it is dropped since the next delta covers it too.
+        Returns True if a frame was dropped.
+        """
+        superseded = self._frame is not None
+        if superseded:
+            self.frames_superseded += 1
+            if self._frame_is_keyframe and not is_keyframe:
+                return True
+        self._frame = wire_bytes
+        self._frame_is_keyframe = is_keyframe
+        return superseded
+
+    def _schedule(self, max_messages, max_bytes):
+        """Moves waiting messages into the send order, up to LANE_WEIGHTS messages per lane each round."""
+        if self._send_order is None:
+            self._send_order = deque()
+        while True:
+            scheduled = len(self._send_order)
+            for message_type, weight in LANE_WEIGHTS.items():
+                for _ in range(weight):
+                    if len(self._send_order) >= max_messages or self._scheduled_bytes >= max_bytes:
+                        return
+                    if message_type == BINARY:
+                        if self._frame is None:
+                            break
+                        wire_bytes, self._frame = self._frame, None
+                        self.queued_bytes += len(wire_bytes)
+                    else:
+                        lane = self._lanes.get(message_type)
+                        if not lane:
+                            break
+                        wire_bytes = lane.popleft()
+                        if not lane:
+                            del self._lanes[message_type]  # idle users keep no empty deques around
+                    self._send_order.append((wire_bytes, message_type))
+                    self._scheduled_bytes += len(wire_bytes)
+            if len(self._send_order) == scheduled:
+                return  # every lane is empty
+
+    def peek(self):
+        """The unsent part of the first message."""
+        if not self._send_order:
+            self._schedule(1, 1)
+        return memoryview(self._send_order[0][0])[self._sent_offset:]
+
+    def peek_batch(self, max_messages, max_bytes):
+        """The unsent part of the first message, followed by as many whole messages as fit in the limits."""
+        self._schedule(max_messages, max_bytes)
+        batch = [self.peek()]
+        size = len(batch[0])
+        for wire_bytes, _ in islice(self._send_order, 1, max_messages):
+            if size + len(wire_bytes) > max_bytes:
+                break
+            batch.append(wire_bytes)
+            size += len(wire_bytes)
+        return batch
+
+    def consume(self, sent):
+        """Marks sent bytes as delivered, moving to the next messages once the first is complete."""
+        self.queued_bytes -= sent
+        self._scheduled_bytes -= sent
+        while sent > 0:
+            remaining = len(self._send_order[0][0]) - self._sent_offset
+            if sent < remaining:
+                self._sent_offset += sent
+                return
+            sent -= remaining
+            _, message_type = self._send_order.popleft()
+            self._sent_offset = 0
+            if message_type == BINARY:
+                self.frames_delivered += 1
+        if not self._send_order:
+            self._send_order = None
+
+    def flush(self, sock, max_messages, max_bytes):
+        """
+        Sends as much as a non-blocking socket takes, and returns how many bytes went out.
+        Connection errors are left to the caller.
+        """
+        total = 0
+        while len(self) > 0:
+            batch = self.peek_batch(max_messages, max_bytes) if HAS_SENDMSG else [self.peek()]
+            try:
+                sent = sock.sendmsg(batch) if HAS_SENDMSG else sock.send(batch[0])
+            except BlockingIOError:
+                return total
+            self.consume(sent)
+            total += sent
+            if sent < sum(map(len, batch)):
+                return total  # the socket buffer is full, wait for the next write event
+        return total
+
+    def clear(self):
+        self._lanes.clear()
+        self._send_order = None
+        self.queued_bytes = 0
+        self._scheduled_bytes = 0
+        self._sent_offset = 0
+        self._frame = None
+
+
 class User:
+    # No per-instance __dict__, the server keeps one of these per connection
+    __slots__ = ("name", "address", "id", "message_queue", "status", "is_sharing_screen", "watchers", "watching",
+                 "share_room", "stream_report_time", "frames_dropped_since_report", "protocol_version",
+                 "compression")
 
     def __init__(self, name, address):
         self.name = name
         self.address = address
         self.id = str(uuid.uuid4())  # unique id for identification
-        self.message_queue = []
+        self.message_queue = OutboundQueue()
         self.status = UserStatus.RegularUser
         self.is_sharing_screen = False
-        self.watchers = []
+        self.watchers = {}  # used as an insertion-ordered set, values are None
         self.watching = None
+        self.share_room = None  # room the screen share is limited to, None for the whole chat
+        self.stream_report_time = 0.0  # when the sharer last got STREAM_STATS
+        self.frames_dropped_since_report = 0
+        self.protocol_version = protocol.PROTOCOL_V1
+        self.compression = False  # compressed payloads were negotiated in the handshake
 
     def __repr__(self):
         return f"User({self.name}, {self.address}, {self.id})"
@@ -27,7 +226,7 @@ class User:
         if self.is_sharing_screen:
             return None
         self.is_sharing_screen = True
-        self.watchers = []
+        self.watchers = {}
         return "User is set"
 
     def is_user_watching_stream(self, user):
@@ -38,10 +237,10 @@ class User:
     def add_user_to_watchers_list(self, user):
         if type(user) is not User:
             raise ValueError("param must be User.")
-        self.watchers.append(user)
+        self.watchers[user] = None
 
     def remove_user_from_watchers_list(self, user):
         if type(user) is not User:
             raise ValueError("param must be User.")
-        self.watchers.remove(user)
+        del self.watchers[user]
 
@@ -3,48 +3,77 @@ import logging
 
 
 class UserManager:
+    """Keeps every connected user, indexed by socket, name and id so each lookup is a dict access."""
 
     def __init__(self):
         self._socket_to_user = {}
+        self._user_to_socket = {}
+        self._name_to_user = {}
+        self._id_to_user = {}
 
     def create_user(self, username, socket, address):
+        """Names are unique, a taken username gets a number appended. Returns the new user."""
+        username = self.get_available_name(username)
         new_user = User(username, address)
         self._socket_to_user[socket] = new_user
+        self._user_to_socket[new_user] = socket
+        self._name_to_user[new_user.name] = new_user
+        self._id_to_user[new_user.id] = new_user
+        return new_user
+
+    def get_available_name(self, username):
+        name, suffix = username, 2
+        while name in self._name_to_user:
+            name = f"{username}{suffix}"
+            suffix += 1
+        return name
+
+    def rename_user(self, user, new_name):
+        """Returns False if the name belongs to another user."""
+        if self._name_to_user.get(new_name, user) is not user:
+            return False
+        del self._name_to_user[user.name]
+        user.name = new_name
+        self._name_to_user[new_name] = user
+        return True
 
     def remove_user(self, socket):
         if socket not in self._socket_to_user:
-            logging.warning(f"Attempt to remove non-existent socket: {socket}")
+            logging.warning("Attempt to remove non-existent socket: %s", socket)  # formatted only if written
             return False  # Return False to indicate failure
 
-        return self._socket_to_user.pop(socket, None)
+        user = self._socket_to_user.pop(socket)
+        del self._user_to_socket[user]
+        del self._name_to_user[user.name]
+        del self._id_to_user[user.id]
+        return user
 
     def get_users(self):
         return self._socket_to_user.values()
 
+    def iter_users_except(self, *excluded_users):
+        """Iterates every user but the given ones without copying the user list, for broadcasts."""
+        return (user for user in self._socket_to_user.values() if user not in excluded_users)
+
     def get_user_by_socket(self, socket):
         if socket not in self._socket_to_user:
-            logging.warning(f"Attempt to get non-existent socket: {socket}")
+            logging.warning("Attempt to get non-existent socket: %s", socket)  # formatted only if written
             return None  # Return None to indicate failure
 
         return self._socket_to_user[socket]
 
     def get_user_by_name(self, username):
         """Returns user by username if exists. if not returns None"""
-        return list(filter(lambda user: user.name == username, self._socket_to_user.values()))
-
-    def get_list_of_users_without_users(self, user_list):
-        if type(user_list) is not list:
-            raise ValueError("user_list must be a list.")
+        return self._name_to_user.get(username)
 
-        new_user_list = list(self._socket_to_user.values())
-        for user in user_list:
-            new_user_list.remove(user)
-        return new_user_list
+    def get_user_by_id(self, user_id):
+        return self._id_to_user.get(user_id)
 
     def get_socket_by_user(self, user):
-        if user and type(user) is User:
-            return list(filter(lambda x: self._socket_to_user[x] == user, self._socket_to_user))[0]
-        return None
+        return self._user_to_socket.get(user)
 
     def clear_user_manager(self):
         self._socket_to_user.clear()
+        self._user_to_socket.clear()
+        self._name_to_user.clear()
+        self._id_to_user.clear()